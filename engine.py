@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+
+"""
+The engine.py file contains the rules of Pelmanism in plain Python,
+with no dependency on App Engine, so games can be played and simulated
+anywhere (game_logic.py adapts the engine to the Game and User models):
+
+1. card_symbols() returns the card values used for a number of pairs
+2. build_deck() builds a shuffled deck of pairs of cards
+3. attempts_range() returns the number of attempts allowed for a
+	number of pairs
+4. bitmask() and positions() convert between a collection of deck
+	positions and a bitmask (bit i is set if position i is included)
+5. display() returns the deck as the player sees it
+6. GameState is a compact representation of a game in progress
+7. check_flip() raises a FlipError if a card can't be turned over
+8. apply_flip() turns over a card and returns the new GameState
+	along with a Flip describing what happened; the GameState passed
+	in is left unchanged
+9. points() works out the points earned in a finished game
+10. pack_move() and unpack_move() convert a completed move to and
+	from a single integer for the move log of a game
+11. replay() plays a list of Moves from the start of a game, yielding
+	the GameState after each one
+
+"""
+
+
+import random
+import string
+from collections import namedtuple
+
+
+DEFAULT_PAIRS = 10
+MIN_PAIRS = 2
+MAX_PAIRS = 500
+# The number of attempts a player may choose is between
+# MIN_ATTEMPTS_PER_PAIR and MAX_ATTEMPTS_PER_PAIR times the number of
+# pairs (30 to 60 for the default deck)
+MIN_ATTEMPTS_PER_PAIR = 3
+MAX_ATTEMPTS_PER_PAIR = 6
+POINTS_PER_GAME = 500
+POINTS_PER_MISS = 10
+# How cards are displayed: FACE_DOWN for a card that hasn't been
+# turned over and REMOVED for a spot whose card has been matched
+FACE_DOWN = '_'
+REMOVED = 'X'
+
+
+def card_symbols(pairs, alphabet=string.ascii_uppercase):
+    """Return a list of pairs distinct card values made from the
+    letters of alphabet: 'A' to 'Z', then 'AA', 'AB' and so on"""
+    base = len(alphabet)
+    symbols = []
+    for n in range(1, pairs + 1):
+        symbol = ''
+        while n:
+            n, r = divmod(n - 1, base)
+            symbol = alphabet[r] + symbol
+        symbols.append(symbol)
+    return symbols
+
+
+def build_deck(pairs=DEFAULT_PAIRS, symbols=None, rng=None):
+    """Return a shuffled list of cards made up of pairs pairs; symbols
+    is a sequence of at least pairs card values (by default
+    card_symbols(pairs)) and rng is a random.Random used for the
+    shuffle (pass a seeded one for a reproducible deck); raise a
+    ValueError for an unsupported number of pairs"""
+    if pairs < MIN_PAIRS or pairs > MAX_PAIRS:
+        raise ValueError('Number of pairs must be between %d and %d'
+                         % (MIN_PAIRS, MAX_PAIRS))
+    if symbols is None:
+        symbols = card_symbols(pairs)
+    elif len(symbols) < pairs:
+        raise ValueError('Not enough card values for %d pairs' % pairs)
+    cards = [symbol for symbol in symbols[:pairs] for _ in range(2)]
+    # random.shuffle is a Fisher-Yates shuffle, so this is O(n)
+    (rng or random).shuffle(cards)
+    return cards
+
+
+def attempts_range(pairs):
+    """Return the smallest and largest number of attempts allowed in a
+    game with pairs pairs"""
+    return pairs * MIN_ATTEMPTS_PER_PAIR, pairs * MAX_ATTEMPTS_PER_PAIR
+
+
+def bitmask(positions):
+    """Return a bitmask with the bit of each position set"""
+    mask = 0
+    for position in positions:
+        mask |= 1 << position
+    return mask
+
+
+def positions(mask):
+    """Return a list of the positions set in a bitmask, in order"""
+    # bin() gives '0b...' with the highest bit first
+    bits = bin(mask)[:1:-1]
+    return [i for i, bit in enumerate(bits) if bit == '1']
+
+
+def display(deck, matched, revealed=()):
+    """Return the deck as the player sees it: the cards at the
+    positions in revealed are face up, matched cards (set in the
+    matched bitmask) are REMOVED and the rest are FACE_DOWN"""
+    disp_deck = [FACE_DOWN] * len(deck)
+    for position in positions(matched):
+        disp_deck[position] = REMOVED
+    for position in revealed:
+        disp_deck[position] = deck[position]
+    return disp_deck
+
+
+class FlipError(Exception):
+    """Raised when a card can't be turned over"""
+
+
+# A completed move: the positions of the two cards turned over,
+# whether they matched and when the move was made (in seconds since
+# the epoch)
+Move = namedtuple('Move', ['first', 'second', 'match', 'timestamp'])
+
+# A move is packed into a single integer (less than 2 ** 63, so it
+# fits a datastore integer): bit 0 is the match flag, bits 1-15 and
+# 16-30 are the positions of the second and first cards and the
+# remaining bits are the timestamp
+POSITION_BITS = 15
+POSITION_MASK = (1 << POSITION_BITS) - 1
+
+
+# The outcome of a single flip; first_index and first_card are None
+# for the first flip of a move, and match, game_over and won are only
+# ever True for the second flip
+Flip = namedtuple('Flip', ['index', 'card', 'first_index', 'first_card',
+                           'match', 'game_over', 'won'])
+
+
+class GameState(object):
+    """The state of a game; deck is a sequence of card values,
+    matched is a bitmask of the positions of matched cards and
+    pending is the position of the first card of the current move
+    (None between moves)"""
+    __slots__ = ('deck', 'matched', 'pending', 'attempts_remaining',
+                 'attempts_made', 'matches_found', 'game_over', 'won')
+
+    def __init__(self, deck, attempts_remaining, matched=0,
+                 pending=None, attempts_made=0, matches_found=0,
+                 game_over=False, won=False):
+        self.deck = deck
+        self.matched = matched
+        self.pending = pending
+        self.attempts_remaining = attempts_remaining
+        self.attempts_made = attempts_made
+        self.matches_found = matches_found
+        self.game_over = game_over
+        self.won = won
+
+    def __repr__(self):
+        return 'GameState(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def check_flip(state, index):
+    """Raise a FlipError if the card at index can't be turned over"""
+    if state.game_over:
+        raise FlipError('The game is already over!')
+    if not 0 <= index < len(state.deck):
+        raise FlipError('Sorry, that\'s not a card in this deck. Try again.')
+    if state.matched >> index & 1:
+        raise FlipError('Sorry, there isn\'t a card there. Try again.')
+    if index == state.pending:
+        raise FlipError('You can\'t pick the same card twice!')
+
+
+def apply_flip(state, index):
+    """Turn over the card at index; return the new GameState and a
+    Flip (state itself is not changed)"""
+    check_flip(state, index)
+    card = state.deck[index]
+
+    # FIRST FLIP of a move
+    if state.pending is None:
+        new_state = GameState(
+            state.deck, state.attempts_remaining, state.matched, index,
+            state.attempts_made, state.matches_found)
+        return new_state, Flip(index, card, None, None, False, False, False)
+
+    # SECOND FLIP of a move
+    first_index = state.pending
+    first_card = state.deck[first_index]
+    match = first_card == card
+    matched = state.matched
+    matches_found = state.matches_found
+    if match:
+        matched |= 1 << first_index | 1 << index
+        matches_found += 1
+    attempts_remaining = state.attempts_remaining - 1
+    won = matches_found == len(state.deck) // 2
+    game_over = won or attempts_remaining < 1
+
+    new_state = GameState(
+        state.deck, attempts_remaining, matched, None,
+        state.attempts_made + 1, matches_found, game_over, won)
+    return new_state, Flip(index, card, first_index, first_card,
+                           match, game_over, won)
+
+
+def points(attempts_made, matches_found):
+    """Return the points earned in a finished game"""
+    return POINTS_PER_GAME - (attempts_made - matches_found) * POINTS_PER_MISS
+
+
+def pack_move(first, second, match, timestamp):
+    """Return a completed move packed into a single integer"""
+    return (int(timestamp) << (2 * POSITION_BITS + 1) |
+            first << (POSITION_BITS + 1) |
+            second << 1 |
+            bool(match))
+
+
+def unpack_move(record):
+    """Return the Move packed into record by pack_move"""
+    return Move(record >> (POSITION_BITS + 1) & POSITION_MASK,
+                record >> 1 & POSITION_MASK,
+                bool(record & 1),
+                record >> (2 * POSITION_BITS + 1))
+
+
+def replay(deck, attempts_allowed, moves):
+    """Play moves (a sequence of Moves) from the start of a game on
+    deck; yield the GameState after each move along with the Flip of
+    its second card; raise a FlipError if a move breaks the rules"""
+    state = GameState(deck, attempts_allowed)
+    for move in moves:
+        state, _ = apply_flip(state, move.first)
+        state, flip = apply_flip(state, move.second)
+        yield state, flip
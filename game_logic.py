@@ -2,121 +2,176 @@
 
 
 """
-The game_logic.py file contains five functions needed to play Pelmanism:
-
-1. deck_creation() creates a list of 20 cards selected at random
-2. guess_error() checks to make sure a chosen card is (a) in the deck
+The game_logic.py file adapts the rules of Pelmanism (see engine.py)
+to the Game and User models; it contains eight functions needed to
+play and replay Pelmanism:
+
+1. deck_creation() creates a deck of cards (20 by default) shuffled
+	at random
+2. game_state() returns an engine.GameState for a Game entity
+3. guess_error() checks to make sure a chosen card is (a) in the deck
 	and (b) is not already part of a matched pair
-3. reset_deck() reset the deck so that cards flipped over in the most
-	recent move are turned back over when the next move starts;
-	cards that have been matched are left as an 'X'
-4. won_or_lost() determines if the game is over and if the player won
+4. apply_flip() turns over a card and updates the Game entity
+5. won_or_lost() determines if the game is over and if the player won
 	or lost; returns a variable (won_lost_msg) that is used in
-	pelmanism_api.py to notify the user that the game is over
-5. points() determines (if the game is over) how many points and
+	pelmanism_api.py to notify the user that the game is over, along
+	with the (unsaved) Score of a finished game
+6. points() determines (if the game is over) how many points and
 	points_per_attempt the player earned
+7. replay() replays the move log of a game to rebuild its state after
+	any number of moves
+8. verify_game() replays a whole game and reports any differences
+	between the replay and the stored game
 
 """
 
 
 import random
+import time
 import endpoints
 
+import engine
+
+
+def deck_creation(pairs=engine.DEFAULT_PAIRS, seed=None):
+    """Create a list of cards (pairs pairs, 20 cards by default)
+    shuffled at random; the same seed always gives the same deck"""
+    return engine.build_deck(pairs, rng=random.Random(seed))
+
+
+def game_state(game):
+    """Return an engine.GameState for the game"""
+    return engine.GameState(
+        game.deck,
+        game.attempts_remaining,
+        matched=game.get_matched(),
+        pending=game.pending_guess,
+        attempts_made=game.attempts_made,
+        matches_found=game.matches_found,
+        game_over=game.game_over)
 
-def deck_creation():
-    """Create a list of 20 cards selected at random"""
-    # Create a starting deck of 20 cards
-    cards = [
-        'A',
-        'A',
-        'B',
-        'B',
-        'C',
-        'C',
-        'D',
-        'D',
-        'E',
-        'E',
-        'F',
-        'F',
-        'G',
-        'G',
-        'H',
-        'H',
-        'I',
-        'I',
-        'J',
-        'J']
-
-    # Set a variable for a card list to modify
-    selection_deck = cards
-    # Set a variable for the deck used in the game
-    game_deck = []
-    game_deck_counter = 0
-
-    # Build the game deck
-    while (game_deck_counter < 20):
-        ran_card = random.choice(cards)
-        selection_deck.remove(ran_card)
-        game_deck.extend(ran_card)
-        game_deck_counter += 1
-    return game_deck
-
-
-def guess_error(guess_int, mli):
+
+def guess_error(state, guess_int):
     """Check to make sure the chosen card is in the deck and is not
     already part of a matched pair"""
-    deck_check = range(20)
-    if guess_int not in deck_check:
-        raise endpoints.BadRequestException(
-            'Sorry, that\'s not a card in this deck. Try again.')
-    if guess_int in mli:
-        raise endpoints.BadRequestException(
-            'Sorry, there isn\'t a card there. Try again.')
-
-
-def reset_deck(disp_deck, mli):
-    """Reset the deck so that cards flipped over in the most
-    recent move are turned back over when the next move starts;
-    cards that have been matched are left as an 'X'"""
-    for x in range(len(disp_deck)):
-        if x in mli:
-            disp_deck[x] = 'X'
-        else:
-            disp_deck[x] = '_'
-
-
-def won_or_lost(game, user, guess1, guess2):
+    try:
+        engine.check_flip(state, guess_int)
+    except engine.FlipError as e:
+        raise endpoints.BadRequestException(str(e))
+
+
+def apply_flip(game, guess_int):
+    """Turn over the chosen card and copy the new state of the game
+    onto the game entity; return the engine.Flip"""
+    state = game_state(game)
+    guess_error(state, guess_int)
+    state, flip = engine.apply_flip(state, guess_int)
+
+    # The displayed deck and the list of matched cards are worked out
+    # from matched when the game is shown, so the copies stored by
+    # older games are dropped
+    game.disp_deck = []
+    game.match_list = []
+    game.match_list_int = []
+    game.matched = state.matched
+    game.pending_guess = state.pending
+    game.guess1_or_guess2 += 1
+    game.attempts_remaining = state.attempts_remaining
+    game.attempts_made = state.attempts_made
+    game.matches_found = state.matches_found
+    return flip
+
+
+def won_or_lost(game, user, flip):
     """Determine if the game is over and if the player won or lost;
-    return the won_lost_msg"""
-    # Add guess1 and guess2 to the guess_history
-    history_msg = 'Guess: ' + guess1 + ', ' + guess2
-    game.guess_history.append(history_msg)
+    return the won_lost_msg and the Score of the game (None if the
+    game isn't over); the caller is responsible for saving the Score"""
+    # Record the move in the move log; games started before the move
+    # log was added keep adding guess1 and guess2 to the guess_history
+    legacy = game.moves is None
+    if legacy:
+        history_msg = 'Guess: ' + flip.first_card + ', ' + flip.card
+        game.guess_history.append(history_msg)
+    else:
+        game.moves.append(engine.pack_move(
+            flip.first_index, flip.index, flip.match, time.time()))
 
-    if game.matches_found == 10:
-        game.end_game(True)
+    score = None
+    if flip.won:
+        score = game.end_game(True)
         user.games_played += 1
         won_lost_msg = ' You win!'
-        history_end_msg = 'User %s won the game! Game over.' % user.name
-        game.guess_history.append(history_end_msg)
-    elif game.attempts_remaining < 1:
-        game.end_game(False)
+        if legacy:
+            history_end_msg = 'User %s won the game! Game over.' % user.name
+            game.guess_history.append(history_end_msg)
+    elif flip.game_over:
+        score = game.end_game(False)
         user.games_played += 1
         won_lost_msg = ' Game over. You\'ve run out of guesses.'
-        history_end_msg = 'User %s lost the game. Game over.' % user.name
-        game.guess_history.append(history_end_msg)
+        if legacy:
+            history_end_msg = 'User %s lost the game. Game over.' % user.name
+            game.guess_history.append(history_end_msg)
     else:
         won_lost_msg = ''
 
-    return won_lost_msg
+    return won_lost_msg, score
 
 
 def points(game, attempts_made, matches_found, user):
     """(If the game is over) determine how many points and
     points_per_attempt the player earned"""
-    if game.matches_found == 10 or game.attempts_remaining < 1:
-        points = (500 - ((attempts_made - matches_found) * 10))
+    if game.game_over:
+        points = engine.points(attempts_made, matches_found)
         total_attempts = user.total_attempts
         total_points = user.total_points + points
         user.total_points = total_points
         user.points_per_attempt = total_points / total_attempts
+
+
+def replay(game, moves=None):
+    """Replay the first moves moves of the game (all of them by
+    default) from its starting deck; return the engine.GameState
+    after the last move replayed"""
+    state = engine.GameState(game.deck, game.attempts_allowed)
+    log = game.move_log()[:moves]
+    for state, _ in engine.replay(game.deck, game.attempts_allowed, log):
+        pass
+    return state
+
+
+def verify_game(game, score=None):
+    """Replay every move of the game under the current rules and
+    return a list of the differences between the replay and the
+    stored game and, for a finished game, its score (an empty list if
+    they agree); only games with a move log (see Game.moves) can be
+    checked"""
+    problems = []
+    pairs = len(game.deck) // 2
+    if game.seed is not None and deck_creation(pairs, game.seed) != game.deck:
+        problems.append('The deck doesn\'t match the seed')
+
+    log = game.move_log()
+    state = engine.GameState(game.deck, game.attempts_allowed)
+    replayed = engine.replay(game.deck, game.attempts_allowed, log)
+    for number, move in enumerate(log, 1):
+        try:
+            state, flip = next(replayed)
+        except engine.FlipError as e:
+            problems.append('Move %d: %s' % (number, e))
+            return problems
+        if flip.match != move.match:
+            problems.append('Move %d: match is %s, not %s'
+                            % (number, flip.match, move.match))
+
+    for name in ('attempts_remaining', 'attempts_made', 'matches_found',
+                 'game_over'):
+        if getattr(state, name) != getattr(game, name):
+            problems.append('%s is %s, not %s' % (
+                name, getattr(state, name), getattr(game, name)))
+    if state.matched != game.get_matched():
+        problems.append('The matched cards are different')
+    if state.game_over and score is not None:
+        points = engine.points(state.attempts_made, state.matches_found)
+        if points != score.points:
+            problems.append('points are %d, not %d' % (points, score.points))
+    return problems
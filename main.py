@@ -2,51 +2,156 @@
 
 
 """
-The main.py file contains two handlers: SendReminderEmail
-and UpdateAverageMovesRemaining.
+The main.py file contains eleven handlers: SendReminderEmail,
+SendReminderEmailPage, SendReminderEmailBatch,
+UpdateAverageMovesRemaining, MigrateGuess1, BackfillUserNames,
+MigrateUserNames, RebuildLeaderboard, RebuildActiveGameStats,
+VerifyGames and RpcStats.
 
 SendReminderEmail sends a reminder email every 24 hours to all
 registered users who have at least one active game. The handler
-is called by a cron job (see cron.yaml).
+is called by a cron job (see cron.yaml). The users are found a page
+at a time by SendReminderEmailPage tasks, and the emails are sent by
+SendReminderEmailBatch tasks, which run in parallel.
 
 UpdateAverageMovesRemaining simply updates the average moves
 remaining for all active games. The handler is called by a
 taskqueue (see the get_average_attempts_remaining endpoint in
-pelmanism_api.py).
+pelmanism_api.py); new games within the same few seconds share a
+single task, and the handler logs how many requests were collapsed
+this way.
+
+MigrateGuess1 moves the first guess of any in-flight move from the
+deprecated Guess1 child entities onto the parent Game (see the
+pending_guess property in models/game.py). The handler is only
+needed once, for games started before the change; it works through
+the Guess1 entities in batches like BackfillUserNames, and each game
+is updated in the same transaction that deletes its Guess1 entity.
+
+BackfillUserNames stores the user's name on every Game and Score
+created before the user_name property was added. The handler works
+through the entities in batches, one task per batch.
+
+MigrateUserNames creates the UserName entity (see
+models/user_name.py) of every user created before UserName was
+added, in batches like BackfillUserNames. Users whose names differ
+only in case can't both have one; these are logged. Once the task
+has finished, NAME_QUERY_FALLBACK in models/user.py can be set to
+False.
+
+RebuildLeaderboard rebuilds the high scores leaderboard (see
+models/leaderboard.py) from the Score entities and clears the cached
+copy in memcache. Shards saved before the leaderboard kept
+LeaderboardEntry entities hold full copies of each Score, including
+its deck; rebuilding the leaderboard once replaces them.
+
+RebuildActiveGameStats recounts the active game totals (see
+models/stats.py) from the Game entities. It is needed once, for games
+created before the totals were kept, and whenever the totals need to
+be checked; new_games also queues it if the totals can't be updated
+for the games it has saved.
+
+VerifyGames replays every finished game that has a move log through
+the current rules of the game (see verify_game in game_logic.py) and
+logs any game whose stored state or score doesn't match the replay,
+e.g. to check the scoring after a rule change. Like BackfillUserNames, it
+works through the games in batches, one task per batch, and logs the
+totals and the rate at which games were replayed when it is done.
+
+RpcStats returns (or clears) the totals measured for each endpoint as
+JSON (see rpc_stats.py); the totals are only recorded on the
+development server, for tools/load_test.py.
 
 """
 
 
+import json
 import logging
+import time
 import webapp2
-from google.appengine.api import mail, app_identity
-from pelmanism_api import PelmanismApi
-from models.user import User
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from pelmanism_api import (PelmanismApi,
+                           MEMCACHE_AVERAGE_ATTEMPTS_SCHEDULED,
+                           MEMCACHE_AVERAGE_ATTEMPTS_COLLAPSED)
 from models.game import Game
+from models.guess1 import Guess1
+from models.score import Score
+from models.user import User
+from models.user_name import UserName
+from models.leaderboard import LeaderboardShard
+from models.stats import ActiveGameStatsShard
+from utils import fill_user_names
+import game_logic
+import rpc_stats
+
+
+BACKFILL_BATCH_SIZE = 500
+REMINDER_PAGE_SIZE = 1000
+REMINDER_BATCH_SIZE = 100
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
     def get(self):
         """Send a reminder email to all users with at least one active game;
-        call the handler every 24 hours using a cron job"""
+        call the handler every 24 hours using a cron job; the work is
+        handed off to SendReminderEmailPage tasks"""
+        taskqueue.add(url='/tasks/send_reminder_page')
+
+
+class SendReminderEmailPage(webapp2.RequestHandler):
+
+    def post(self):
+        """Find one page of users with at least one active game and
+        queue a SendReminderEmailBatch task for every
+        REMINDER_BATCH_SIZE users; queue a task for the next page"""
+        # A projection query only reads the index, and distinct
+        # returns each user once however many active games they have
+        query = Game.query(Game.game_over == False,
+                           Game.cancelled == False,
+                           projection=[Game.user],
+                           distinct=True)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = query.fetch_page(
+            REMINDER_PAGE_SIZE, start_cursor=cursor)
+        user_keys = [game.user.urlsafe() for game in games]
+
+        tasks = [taskqueue.Task(url='/tasks/send_reminder_batch',
+                                params={'user_key': user_keys[
+                                    i:i + REMINDER_BATCH_SIZE]})
+                 for i in range(0, len(user_keys), REMINDER_BATCH_SIZE)]
+        if more and next_cursor:
+            tasks.append(taskqueue.Task(
+                url='/tasks/send_reminder_page',
+                params={'cursor': next_cursor.urlsafe()}))
+        if tasks:
+            taskqueue.Queue().add(tasks)
+        self.response.set_status(204)
+
+
+class SendReminderEmailBatch(webapp2.RequestHandler):
+
+    def post(self):
+        """Send a reminder email to each user in the batch that has
+        an email address"""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        user_keys = [ndb.Key(urlsafe=key)
+                     for key in self.request.get_all('user_key')]
         msg = ('\n\nIt looks like you started a Pelmanism game, '
                'but haven\'t finished. Come back and find some matches!')
-        for user in users:
-            games = Game.query(Game.user == user.key).fetch()
-            for game in games:
-                if not game.game_over and not game.cancelled:
-                    subject = 'Where did you go?'
-                    body = 'Hi, {}!'.format(user.name) + msg
-                    # This will send test emails to all users
-                    mail.send_mail(
-                        'noreply@{}.appspotmail.com'.format(app_id),
-                        user.email,
-                        subject,
-                        body)
-                    break
+        for user in ndb.get_multi(user_keys):
+            if user and user.email:
+                subject = 'Where did you go?'
+                body = 'Hi, {}!'.format(user.name) + msg
+                # This will send test emails to all users
+                mail.send_mail(
+                    'noreply@{}.appspotmail.com'.format(app_id),
+                    user.email,
+                    subject,
+                    body)
+        self.response.set_status(204)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
@@ -54,11 +159,249 @@ class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
         """Update average moves remaining"""
         PelmanismApi._cache_average_attempts()
+        counts = memcache.get_multi([MEMCACHE_AVERAGE_ATTEMPTS_SCHEDULED,
+                                     MEMCACHE_AVERAGE_ATTEMPTS_COLLAPSED])
+        logging.info(
+            'Average moves remaining updated; %d updates scheduled and '
+            '%d requests collapsed so far',
+            counts.get(MEMCACHE_AVERAGE_ATTEMPTS_SCHEDULED, 0),
+            counts.get(MEMCACHE_AVERAGE_ATTEMPTS_COLLAPSED, 0))
+        self.response.set_status(204)
+
+
+class MigrateGuess1(webapp2.RequestHandler):
+
+    def get(self):
+        """Start the migration with the first batch of Guess1
+        entities"""
+        taskqueue.add(url='/tasks/migrate_guess1')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of Guess1 entities and queue a task for
+        the next batch"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Guess1.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        migrated = sum(1 for key in keys if self._migrate(key))
+        logging.info('Migrated %d pending guesses', migrated)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_guess1',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+    @staticmethod
+    @ndb.transactional
+    def _migrate(guess1_key):
+        """Copy a Guess1 entity onto its parent game as the game's
+        pending_guess and delete the Guess1 entity in one transaction
+        (the two are in the same entity group); return True if the
+        game was updated"""
+        guess1, game = ndb.get_multi([guess1_key, guess1_key.parent()])
+        if guess1 is None:
+            return False
+        migrated = game is not None and game.pending_guess is None and \
+            game.guess1_or_guess2 % 2 == 1
+        if migrated:
+            game.pending_guess = guess1.guess1_int
+            game.put()
+        guess1_key.delete()
+        return migrated
+
+
+class BackfillUserNames(webapp2.RequestHandler):
+
+    def get(self):
+        """Start the backfill with the Game entities"""
+        taskqueue.add(url='/tasks/backfill_user_names',
+                      params={'kind': 'Game'})
+        self.response.set_status(202)
+
+    def post(self):
+        """Fill in user_name for one batch of Game or Score entities
+        and queue a task for the next batch"""
+        kind = self.request.get('kind')
+        model = {'Game': Game, 'Score': Score}[kind]
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        entities, next_cursor, more = model.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        missing = [e for e in entities if e.user_name is None]
+        if missing and kind == 'Game':
+            # Games may be played while the backfill runs, so each one
+            # is read again and updated in a transaction rather than
+            # overwritten with the copy read by the query
+            for game in fill_user_names(missing):
+                if game.user_name is not None:
+                    self._fill_game_user_name(game.key, game.user_name)
+        elif missing:
+            # Scores are never changed once written
+            ndb.put_multi(fill_user_names(missing))
+        logging.info('Backfilled %d %s entities', len(missing), kind)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_names',
+                          params={'kind': kind,
+                                  'cursor': next_cursor.urlsafe()})
+        elif kind == 'Game':
+            taskqueue.add(url='/tasks/backfill_user_names',
+                          params={'kind': 'Score'})
+        self.response.set_status(204)
+
+    @staticmethod
+    @ndb.transactional
+    def _fill_game_user_name(game_key, user_name):
+        """Set the user_name of a game unless it has been set since
+        the game was read"""
+        game = game_key.get()
+        if game is not None and game.user_name is None:
+            game.user_name = user_name
+            game.put()
+
+
+class MigrateUserNames(webapp2.RequestHandler):
+
+    def get(self):
+        """Start the migration"""
+        taskqueue.add(url='/tasks/migrate_user_names')
+        self.response.set_status(202)
+
+    def post(self):
+        """Create the missing UserName entities for one batch of users
+        and queue a task for the next batch"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        keys = [UserName.key_for(user.name) for user in users]
+        owners = dict((user_name.key, user_name.user)
+                      for user_name in ndb.get_multi(keys) if user_name)
+
+        missing = []
+        for user, key in zip(users, keys):
+            if key not in owners:
+                owners[key] = user.key
+                missing.append(UserName(key=key, user=user.key))
+            elif owners[key] != user.key:
+                logging.warning('The name %s of user %s is already taken',
+                                user.name, user.key.urlsafe())
+        ndb.put_multi(missing)
+        logging.info('Migrated %d user names', len(missing))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_user_names',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+
+    def get(self):
+        """Rebuild the leaderboard from scratch"""
+        LeaderboardShard.rebuild()
+        self.response.set_status(204)
+
+
+class RebuildActiveGameStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Recount the number of active games and their attempts
+        remaining"""
+        self.post()
+
+    def post(self):
+        """Recount the active game totals (queued by new_games when
+        its update of the totals fails)"""
+        games = attempts_remaining = 0
+        active_games = Game.query(Game.game_over == False,
+                                  Game.cancelled == False)
+        for game in active_games.iter(batch_size=BACKFILL_BATCH_SIZE):
+            games += 1
+            attempts_remaining += game.attempts_remaining
+        ActiveGameStatsShard.rebuild(games, attempts_remaining)
+        PelmanismApi._cache_average_attempts()
+        logging.info('Counted %d active games', games)
+        self.response.set_status(204)
+
+
+class VerifyGames(webapp2.RequestHandler):
+
+    def get(self):
+        """Start replaying the finished games"""
+        taskqueue.add(url='/tasks/verify_games')
+        self.response.set_status(202)
+
+    def post(self):
+        """Replay one batch of finished games, log the games that
+        don't match their replay and queue a task for the next batch;
+        the running totals are passed from task to task"""
+        checked = int(self.request.get('checked') or 0)
+        failed = int(self.request.get('failed') or 0)
+        no_score = int(self.request.get('no_score') or 0)
+        seconds = float(self.request.get('seconds') or 0)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.game_over == True).fetch_page(
+                BACKFILL_BATCH_SIZE, start_cursor=cursor)
+
+        # Games started before the move log was added can't be
+        # replayed
+        games = [game for game in games if game.moves is not None]
+        # Games finished before scores were keyed by their game have
+        # no score to check the points against
+        scores = ndb.get_multi([Score.key_for_game(game.key)
+                                for game in games])
+        no_score += scores.count(None)
+
+        start = time.time()
+        for game, score in zip(games, scores):
+            checked += 1
+            problems = game_logic.verify_game(game, score)
+            if problems:
+                failed += 1
+                logging.warning('Game %s: %s', game.key.urlsafe(),
+                                '; '.join(problems))
+        seconds += time.time() - start
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/verify_games',
+                          params={'cursor': next_cursor.urlsafe(),
+                                  'checked': checked,
+                                  'failed': failed,
+                                  'no_score': no_score,
+                                  'seconds': seconds})
+        else:
+            logging.info('Replayed %d games (%d games a second); %d '
+                         'didn\'t match and the points of %d couldn\'t '
+                         'be checked', checked,
+                         checked / seconds if seconds else 0, failed,
+                         no_score)
+        self.response.set_status(204)
+
+
+class RpcStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Return the totals recorded for each endpoint"""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(rpc_stats.totals()))
+
+    def delete(self):
+        """Clear the totals"""
+        rpc_stats.reset_totals()
         self.response.set_status(204)
 
 
 # Register routes that point to the handlers defined above
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder_page', SendReminderEmailPage),
+    ('/tasks/send_reminder_batch', SendReminderEmailBatch),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/migrate_guess1', MigrateGuess1),
+    ('/tasks/backfill_user_names', BackfillUserNames),
+    ('/tasks/migrate_user_names', MigrateUserNames),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/rebuild_active_game_stats', RebuildActiveGameStats),
+    ('/tasks/verify_games', VerifyGames),
+    ('/tasks/rpc_stats', RpcStats),
 ], debug=True)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+
+"""
+The compact.py file contains the binary encoding used for games stored
+in compact mode (see COMPACT_STORAGE in models/game.py). A compact
+game keeps its board and its history in a single unindexed blob
+instead of several repeated properties.
+
+The blob starts with a header (FORMAT): a version byte, a flags byte
+and the length of each section that follows. The sections are the
+deck (card values separated by SEPARATOR), the matched bitmask
+(big-endian bytes), the guess history of older games (entries
+separated by SEPARATOR) and the move log (see pack_moves); the
+HAS_MOVES flag tells an empty move log from a game that has none. The
+version byte lets the format change without breaking games that are
+already stored; blobs written in version 1 (FORMAT_V1, with no flags
+or move log) can still be read.
+
+pack_moves() and unpack_moves() are also used for the move log of
+games that aren't stored in compact mode (see MoveLogProperty in
+models/game.py).
+
+"""
+
+
+import binascii
+import struct
+
+
+VERSION = 2
+FORMAT = '>BBIIII'
+FORMAT_V1 = '>BIII'
+HAS_MOVES = 1
+SEPARATOR = u'\x00'
+# Each move record (see engine.pack_move) is an unsigned 64-bit int
+MOVE_FORMAT = '>%dQ'
+
+
+def int_to_bytes(value):
+    """Return a non-negative int as big-endian bytes"""
+    hexed = '%x' % value
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    return binascii.unhexlify(hexed)
+
+
+def bytes_to_int(value):
+    """Return the int encoded by int_to_bytes"""
+    return int(binascii.hexlify(value), 16) if value else 0
+
+
+def _join(strings):
+    return SEPARATOR.join(strings).encode('utf-8')
+
+
+def _split(data):
+    return data.decode('utf-8').split(SEPARATOR) if data else []
+
+
+def pack_moves(moves):
+    """Return the bytes for a move log (a list of move records)"""
+    return struct.pack(MOVE_FORMAT % len(moves), *moves)
+
+
+def unpack_moves(data):
+    """Return the move log encoded by pack_moves"""
+    return list(struct.unpack(MOVE_FORMAT % (len(data) // 8), data))
+
+
+def pack_state(deck, matched, history, moves=None):
+    """Return the blob for a game's deck (a list of card values),
+    matched bitmask, guess history (a list of strings) and move log (a
+    list of move records, or None for a game without one)"""
+    deck_bytes = _join(deck)
+    matched_bytes = int_to_bytes(matched or 0)
+    history_bytes = _join(history)
+    moves_bytes = pack_moves(moves or [])
+    flags = HAS_MOVES if moves is not None else 0
+    header = struct.pack(FORMAT, VERSION, flags, len(deck_bytes),
+                         len(matched_bytes), len(history_bytes),
+                         len(moves_bytes))
+    return b''.join((header, deck_bytes, matched_bytes, history_bytes,
+                     moves_bytes))
+
+
+def unpack_state(blob):
+    """Return the deck, matched bitmask, guess history and move log
+    (None if the game has none) stored in a blob made by pack_state;
+    raise a ValueError for an unknown version"""
+    version = struct.unpack_from('>B', blob)[0]
+    if version == 1:
+        _, deck_len, matched_len, history_len = struct.unpack_from(
+            FORMAT_V1, blob)
+        flags, moves_len = 0, 0
+        start = struct.calcsize(FORMAT_V1)
+    elif version == VERSION:
+        (_, flags, deck_len, matched_len, history_len,
+         moves_len) = struct.unpack_from(FORMAT, blob)
+        start = struct.calcsize(FORMAT)
+    else:
+        raise ValueError('Unknown compact game format %d' % version)
+    deck = _split(blob[start:start + deck_len])
+    start += deck_len
+    matched = bytes_to_int(blob[start:start + matched_len])
+    start += matched_len
+    history = _split(blob[start:start + history_len])
+    start += history_len
+    moves = None
+    if flags & HAS_MOVES:
+        moves = unpack_moves(blob[start:start + moves_len])
+    return deck, matched, history, moves
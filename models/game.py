@@ -11,62 +11,230 @@ from datetime import datetime
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import engine
+from models.compact import (int_to_bytes,
+                            bytes_to_int,
+                            pack_moves,
+                            unpack_moves,
+                            pack_state,
+                            unpack_state)
+from models.score import Score
+
+
+# Set COMPACT_STORAGE to True to store new games in compact mode: the
+# deck, the matched bitmask and the move log are packed into a
+# single unindexed blob (see models/compact.py) rather than stored as
+# separate (indexed, repeated) properties; games keep the mode they
+# were created in
+COMPACT_STORAGE = False
+# How long (in seconds) a game stays in memcache once it has been
+# cached, so that games that are no longer being played drop out
+GAME_MEMCACHE_TIMEOUT = 60 * 60
+
+
+class BitmaskProperty(ndb.BlobProperty):
+    """A bitmask of any length (an int), stored as big-endian bytes"""
+
+    def _validate(self, value):
+        if not isinstance(value, (int, long)) or value < 0:
+            raise TypeError('Expected a non-negative int, got %r' % value)
+
+    def _to_base_type(self, value):
+        return int_to_bytes(value)
+
+    def _from_base_type(self, value):
+        return bytes_to_int(value)
+
+
+class MoveLogProperty(ndb.BlobProperty):
+    """A list of move records (see engine.pack_move), stored as 8 bytes
+    per move"""
+
+    def _validate(self, value):
+        if not isinstance(value, list):
+            raise TypeError('Expected a list of moves, got %r' % value)
+
+    def _to_base_type(self, value):
+        return pack_moves(value)
+
+    def _from_base_type(self, value):
+        return unpack_moves(value)
+
 
 # Define game objects
 class Game(ndb.Model):
-    """Game object"""
-    deck = ndb.StringProperty(repeated=True)
-    disp_deck = ndb.StringProperty(repeated=True)
-    attempts_allowed = ndb.IntegerProperty(required=True)
-    attempts_remaining = ndb.IntegerProperty(required=True, default=30)
+    """Game object; only the properties used in queries (game_over,
+    cancelled, time_created and user) are indexed"""
+    # Games are read by key on every call while they are being played,
+    # so they are kept in the in-context cache and in memcache (reads
+    # inside a transaction always go to the datastore)
+    _use_cache = True
+    _use_memcache = True
+    _memcache_timeout = GAME_MEMCACHE_TIMEOUT
+    deck = ndb.StringProperty(repeated=True, indexed=False)
+    # The seed used to shuffle the deck (see game_logic.deck_creation)
+    seed = ndb.IntegerProperty(indexed=False)
+    # DEPRECATED: disp_deck and match_list are worked out from matched
+    # (see display_deck and matched_cards); they are only set on games
+    # started before the change and are emptied on the next move
+    disp_deck = ndb.StringProperty(repeated=True, indexed=False)
+    attempts_allowed = ndb.IntegerProperty(required=True, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(required=True, default=30,
+                                             indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
-    attempts_made = ndb.IntegerProperty(required=True)
-    match_list = ndb.StringProperty(repeated=True)
-    match_list_int = ndb.IntegerProperty(repeated=True)
-    matches_found = ndb.IntegerProperty(required=True)
-    guess1_or_guess2 = ndb.IntegerProperty()
+    attempts_made = ndb.IntegerProperty(required=True, indexed=False)
+    match_list = ndb.StringProperty(repeated=True, indexed=False)
+    # DEPRECATED: replaced by matched; only read for games started
+    # before matched was added and emptied on the next move
+    match_list_int = ndb.IntegerProperty(repeated=True, indexed=False)
+    # Bitmask of the positions of matched cards (bit i is set once
+    # the card at position i has been matched)
+    matched = BitmaskProperty()
+    matches_found = ndb.IntegerProperty(required=True, indexed=False)
+    guess1_or_guess2 = ndb.IntegerProperty(indexed=False)
+    pending_guess = ndb.IntegerProperty(indexed=False)
     cancelled = ndb.BooleanProperty(required=True, default=False)
-    guess_history = ndb.StringProperty(repeated=True)
+    # DEPRECATED: replaced by moves; only set on games started before
+    # moves was added, which keep adding to it
+    guess_history = ndb.StringProperty(repeated=True, indexed=False)
+    # One record per completed move (see engine.pack_move); the text of
+    # the history is worked out from it when the game history is shown.
+    # None for games started before moves was added
+    moves = MoveLogProperty()
     time_created = ndb.StringProperty(required=True)
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of the user's name so that forms can be filled in without
+    # looking up the user; older games are filled in by
+    # utils.fill_user_names (or permanently by BackfillUserNames)
+    user_name = ndb.StringProperty(indexed=False)
+    # Set for games stored in compact mode (see COMPACT_STORAGE)
+    packed_state = ndb.BlobProperty(indexed=False)
+
+    def _to_pb(self, *args, **kwargs):
+        """In compact mode, store the deck, the matched bitmask, the
+        guess history and the move log in packed_state instead of their
+        own properties"""
+        if self.packed_state is None:
+            return super(Game, self)._to_pb(*args, **kwargs)
+        state = (self.deck, self.matched, self.guess_history, self.moves)
+        self.packed_state = pack_state(*state)
+        self.deck, self.matched, self.guess_history, self.moves = (
+            [], None, [], None)
+        try:
+            return super(Game, self)._to_pb(*args, **kwargs)
+        finally:
+            self.deck, self.matched, self.guess_history, self.moves = state
+
+    @classmethod
+    def _from_pb(cls, *args, **kwargs):
+        """Unpack the deck, the matched bitmask, the guess history and
+        the move log of a game stored in compact mode; entities from
+        projection queries don't have packed_state and are left as
+        they are"""
+        game = super(Game, cls)._from_pb(*args, **kwargs)
+        if not game._projection and game.packed_state:
+            (game.deck, game.matched, game.guess_history,
+             game.moves) = unpack_state(game.packed_state)
+        return game
 
     @classmethod
-    def new_game(cls, user, attempts, deck, disp_deck, attempts_made,
-                 match_list, match_list_int, matches_found,
-                 guess1_or_guess2, guess_history):
-        """Create and return a new game"""
-        if attempts < 30 or attempts > 60:
+    def new_game(cls, user, attempts, deck, attempts_made, matches_found,
+                 guess1_or_guess2, guess_history, user_name=None,
+                 seed=None):
+        """Create, save and return a new game (see build)"""
+        game = cls.build(user, attempts, deck, attempts_made,
+                         matches_found, guess1_or_guess2, guess_history,
+                         user_name, seed)
+        game.put()
+        return game
+
+    @classmethod
+    def build(cls, user, attempts, deck, attempts_made, matches_found,
+              guess1_or_guess2, guess_history, user_name=None, seed=None):
+        """Return a new game without saving it, so that many games can
+        be saved at once; the number of attempts allowed depends on the
+        size of the deck (30 to 60 for 20 cards); raise a ValueError
+        for a number of attempts outside that range"""
+        min_attempts, max_attempts = engine.attempts_range(len(deck) // 2)
+        if attempts < min_attempts or attempts > max_attempts:
             raise ValueError(
-                'Number of attempts must be more than 29 and less than 61')
+                'Number of attempts must be more than %d and less than %d'
+                % (min_attempts - 1, max_attempts + 1))
         game = Game(
             user=user,
+            user_name=user_name,
             deck=deck,
+            seed=seed,
             attempts_allowed=attempts,
             attempts_remaining=attempts,
-            disp_deck=disp_deck,
             attempts_made=attempts_made,
-            match_list=match_list,
-            match_list_int=match_list_int,
+            matched=0,
             matches_found=matches_found,
             guess1_or_guess2=guess1_or_guess2,
             game_over=False,
             cancelled=False,
             guess_history=guess_history,
-            time_created=str(datetime.now()))
-        game.put()
+            moves=[],
+            time_created=str(datetime.now()),
+            packed_state=b'' if COMPACT_STORAGE else None)
         return game
 
-    def to_form(self, message):
-        """Return a GameForm representation of the game"""
+    def display_deck(self, revealed=None):
+        """Return the deck as the player sees it; revealed is a list of
+        the positions of cards that are face up (by default just the
+        first card of a move in progress)"""
+        if revealed is None:
+            revealed = [] if self.pending_guess is None \
+                else [self.pending_guess]
+        return engine.display(self.deck, self.get_matched(), revealed)
+
+    def matched_cards(self):
+        """Return the values of the matched cards (in order, so each
+        pair is together)"""
+        return sorted(self.deck[position] for position in
+                      engine.positions(self.get_matched()))
+
+    def get_matched(self):
+        """Return the matched bitmask, working it out from
+        match_list_int for games started before matched was added"""
+        if self.matched is None:
+            return engine.bitmask(self.match_list_int)
+        return self.matched
+
+    def move_log(self):
+        """Return the completed moves of the game as engine.Move tuples
+        (an empty list for games started before moves was added)"""
+        return [engine.unpack_move(record) for record in self.moves or []]
+
+    def history(self):
+        """Return the guess history of the game as text: a line for
+        each move and, once the game is over, a line saying how it
+        ended"""
+        if self.moves is None:
+            return self.guess_history
+        lines = ['Guess: %s, %s' % (self.deck[move.first],
+                                    self.deck[move.second])
+                 for move in self.move_log()]
+        if self.game_over:
+            if self.matches_found == len(self.deck) // 2:
+                end_msg = 'User %s won the game! Game over.'
+            else:
+                end_msg = 'User %s lost the game. Game over.'
+            lines.append(end_msg % self.get_user_name())
+        return lines
+
+    def to_form(self, message, revealed=None):
+        """Return a GameForm representation of the game; revealed is
+        passed on to display_deck"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = self.get_user_name()
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.cancelled = self.cancelled
-        form.disp_deck = self.disp_deck
+        form.disp_deck = self.display_deck(revealed)
         form.attempts_made = self.attempts_made
-        form.match_list = self.match_list
+        form.match_list = self.matched_cards()
         form.matches_found = self.matches_found
         form.time_created = self.time_created
         form.message = message
@@ -78,12 +246,12 @@ class Game(ndb.Model):
         used in the get_user_games endpoint"""
         return GameFormUserGame(
             urlsafe_key=self.key.urlsafe(),
-            user_name=self.user.get().name,
+            user_name=self.get_user_name(),
             attempts_remaining=self.attempts_remaining,
             game_over=self.game_over,
-            disp_deck=self.disp_deck,
+            disp_deck=self.display_deck(),
             attempts_made=self.attempts_made,
-            match_list=self.match_list,
+            match_list=self.matched_cards(),
             matches_found=self.matches_found,
             time_created=self.time_created)
 
@@ -92,34 +260,71 @@ class Game(ndb.Model):
         this form displays a custom list of the game entities and is
         used in the get_game_history endpoint"""
         return GameHistory(
-            user_name=self.user.get().name,
-            guess_history=self.guess_history,
+            user_name=self.get_user_name(),
+            guess_history=self.history(),
             attempts_made=self.attempts_made,
-            match_list=self.match_list,
+            match_list=self.matched_cards(),
             matches_found=self.matches_found,
             deck=self.deck,
             time_created=self.time_created,
+            message=message,
+            moves=[MoveForm(first=move.first,
+                            second=move.second,
+                            match=move.match,
+                            timestamp=move.timestamp)
+                   for move in self.move_log()])
+
+    def to_form_replay(self, state, move, message):
+        """Return a ReplayForm representation of the game as it was
+        after move moves; state is the engine.GameState rebuilt by
+        game_logic.replay, and the cards of the last move replayed are
+        shown face up"""
+        revealed = []
+        if move:
+            last = engine.unpack_move(self.moves[move - 1])
+            revealed = [last.first, last.second]
+        return ReplayForm(
+            urlsafe_key=self.key.urlsafe(),
+            move=move,
+            total_moves=len(self.moves),
+            disp_deck=engine.display(self.deck, state.matched, revealed),
+            attempts_remaining=state.attempts_remaining,
+            attempts_made=state.attempts_made,
+            match_list=sorted(self.deck[position] for position in
+                              engine.positions(state.matched)),
+            matches_found=state.matches_found,
+            game_over=state.game_over,
             message=message)
 
+    def get_user_name(self):
+        """Return the name of the game's user, looking the user up
+        only if the name hasn't been stored on the game"""
+        if self.user_name is None:
+            self.user_name = self.user.get().name
+        return self.user_name
+
     def end_game(self, won=False):
         """End the game; if won is True, the player won;
-        if won is False, the player lost"""
+        if won is False, the player lost; return the Score for the
+        game (neither the game nor the score is saved here, so that
+        both can be written with the rest of the move)"""
         self.game_over = True
-        self.put()
 
         # Add the game to the score board
         # (a score is only returned when a game ends)
-        points = self.points = (
-            500 - ((self.attempts_made - self.matches_found) * 10))
+        points = self.points = engine.points(
+            self.attempts_made, self.matches_found)
         score = Score(
+            key=Score.key_for_game(self.key),
             user=self.user,
+            user_name=self.user_name,
             time_completed=str(datetime.now()),
             won=won,
             attempts_made=self.attempts_made,
             game_deck=self.deck,
             matches_found=self.matches_found,
             points=points)
-        score.put()
+        return score
 
 
 # Message definitions
@@ -153,14 +358,38 @@ class GameFormUserGame(messages.Message):
 
 
 class GameForms(messages.Message):
-    """Outbound container for a list of GameFormUserGame forms"""
+    """Outbound container for a list of GameFormUserGame forms;
+    next_cursor is used to request the next page of games"""
     items = messages.MessageField(GameFormUserGame, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
-    """Inbound form used to create a new game"""
+    """Inbound form used to create a new game; pairs is the number of
+    pairs of cards in the deck"""
     user_name = messages.StringField(1, required=True)
     attempts = messages.IntegerField(2, required=True)
+    pairs = messages.IntegerField(3, default=engine.DEFAULT_PAIRS)
+
+
+class NewGamesForm(messages.Message):
+    """Inbound form used to create games in bulk; games_per_user games
+    are created for each user in user_names"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    attempts = messages.IntegerField(3, required=True)
+    pairs = messages.IntegerField(4, default=engine.DEFAULT_PAIRS)
+
+
+class GameKeyForm(messages.Message):
+    """Used for outbound information on a game created by new_games"""
+    urlsafe_key = messages.StringField(1, required=True)
+    user_name = messages.StringField(2, required=True)
+
+
+class GameKeyForms(messages.Message):
+    """Outbound container for a list of GameKeyForm forms"""
+    items = messages.MessageField(GameKeyForm, 1, repeated=True)
 
 
 class MakeMoveForm(messages.Message):
@@ -168,6 +397,30 @@ class MakeMoveForm(messages.Message):
     guess = messages.IntegerField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Inbound form used to make a number of guesses at once; the
+    guesses are made in order"""
+    guesses = messages.IntegerField(1, repeated=True)
+
+
+class FlipForm(messages.Message):
+    """Used for outbound information on a single guess sent to
+    make_moves; made is False (and card is empty) for a guess that
+    couldn't be made, and message says why"""
+    guess = messages.IntegerField(1, required=True)
+    made = messages.BooleanField(2, required=True)
+    card = messages.StringField(3)
+    message = messages.StringField(4, required=True)
+
+
+class FlipForms(messages.Message):
+    """Outbound container for the FlipForm of each guess sent to
+    make_moves (up to and including the first one that couldn't be
+    made) and the final state of the game"""
+    items = messages.MessageField(FlipForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
+
+
 class ScoreForm(messages.Message):
     """Used for outbound score information for finished games"""
     user_name = messages.StringField(1, required=True)
@@ -184,9 +437,20 @@ class ScoreForms(messages.Message):
     items = messages.MessageField(ScoreForm, 1, repeated=True)
 
 
+class MoveForm(messages.Message):
+    """Used for outbound information on a single move; first and
+    second are the positions of the cards turned over and timestamp is
+    when the move was made (in seconds since the epoch)"""
+    first = messages.IntegerField(1, required=True)
+    second = messages.IntegerField(2, required=True)
+    match = messages.BooleanField(3, required=True)
+    timestamp = messages.IntegerField(4, required=True)
+
+
 class GameHistory(messages.Message):
     """Used for outbound information on each guess made
-    and the outcome of a game"""
+    and the outcome of a game; moves is empty for games started
+    before the move log was added"""
     user_name = messages.StringField(1, required=True)
     guess_history = messages.StringField(2, repeated=True)
     attempts_made = messages.IntegerField(3, required=True)
@@ -195,6 +459,22 @@ class GameHistory(messages.Message):
     deck = messages.StringField(6, repeated=True)
     time_created = messages.StringField(7, required=True)
     message = messages.StringField(8)
+    moves = messages.MessageField(MoveForm, 9, repeated=True)
+
+
+class ReplayForm(messages.Message):
+    """Used for outbound information on the state of a game after a
+    number of moves (move) have been replayed"""
+    urlsafe_key = messages.StringField(1, required=True)
+    move = messages.IntegerField(2, required=True)
+    total_moves = messages.IntegerField(3, required=True)
+    disp_deck = messages.StringField(4, repeated=True)
+    attempts_remaining = messages.IntegerField(5, required=True)
+    attempts_made = messages.IntegerField(6, required=True)
+    match_list = messages.StringField(7, repeated=True)
+    matches_found = messages.IntegerField(8, required=True)
+    game_over = messages.BooleanField(9, required=True)
+    message = messages.StringField(10)
 
 
 class StringMessage(messages.Message):
@@ -15,6 +15,10 @@ from google.appengine.ext import ndb
 class Guess1(ndb.Model):
     """Guess1 object; each Guess1 model is given a parent (game.key) in
     pelmansim_api.py; the Guess1 model is compared with the guess2 and
-    guess2_int attributes in the make_move endpoint in pelmansim_api.py"""
-    guess1 = ndb.StringProperty(required=True)
-    guess1_int = ndb.IntegerProperty(required=True)
+    guess2_int attributes in the make_move endpoint in pelmansim_api.py
+
+    DEPRECATED: the first guess of a move is now kept on the Game
+    (game.pending_guess); Guess1 is only read for games that were
+    started before the change (see MigrateGuess1 in main.py)"""
+    guess1 = ndb.StringProperty(required=True, indexed=False)
+    guess1_int = ndb.IntegerProperty(required=True, indexed=False)
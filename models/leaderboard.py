@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+
+"""
+The leaderboard.py file defines the LeaderboardShard model, which keeps
+a precomputed list of the highest scores for the get_high_scores
+endpoint.
+
+The leaderboard is split across NUM_SHARDS entities. A finished game's
+score is offered to one shard chosen at random, and each shard keeps
+only its own top LEADERBOARD_SIZE scores, so the overall top scores
+are always found by merging the shards. The shards keep a
+LeaderboardEntry for each score rather than a copy of the Score, so
+that a shard (and the merged list) stays small whatever the size of
+the decks played. The merged list is cached in
+memcache under a version number, which is moved on whenever a shard
+changes, so a list merged from the shards before a change can't be
+cached as the current one.
+
+"""
+
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models.score import Score, ScoreForm
+from utils import fill_user_names
+
+
+LEADERBOARD_SIZE = 100
+NUM_SHARDS = 10
+MEMCACHE_LEADERBOARD = 'LEADERBOARD_%d'
+MEMCACHE_LEADERBOARD_VERSION = 'LEADERBOARD_VERSION'
+# The cached leaderboard is also dropped after this many seconds, in
+# case a change to a shard was missed
+LEADERBOARD_CACHE_TIME = 60
+
+
+# Define leaderboard entry object
+class LeaderboardEntry(ndb.Model):
+    """The part of a Score shown on the leaderboard; the deck of the
+    game isn't kept, so the entry's size doesn't grow with the deck"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty()
+    time_completed = ndb.StringProperty(required=True)
+    won = ndb.BooleanProperty(required=True)
+    attempts_made = ndb.IntegerProperty(required=True)
+    matches_found = ndb.IntegerProperty(required=True)
+    points = ndb.IntegerProperty(required=True)
+    score = ndb.KeyProperty(kind='Score')
+
+    @classmethod
+    def from_score(cls, score):
+        """Return the leaderboard entry for a score"""
+        return cls(
+            user=score.user,
+            user_name=score.user_name,
+            time_completed=score.time_completed,
+            won=score.won,
+            attempts_made=score.attempts_made,
+            matches_found=score.matches_found,
+            points=score.points,
+            score=score.key)
+
+    def to_form(self):
+        """Return a ScoreForm representation of the entry (without the
+        deck of the game)"""
+        return ScoreForm(
+            user_name=self.user_name,
+            won=self.won,
+            time_completed=self.time_completed,
+            attempts_made=self.attempts_made,
+            matches_found=self.matches_found,
+            points=self.points)
+
+
+# Define leaderboard object
+class LeaderboardShard(ndb.Model):
+    """One shard of the leaderboard; scores are LeaderboardEntry
+    copies of Score entities ordered by points (highest first)"""
+    # The merged leaderboard has its own memcache entry (see
+    # top_scores), so the shards themselves aren't cached there
+    _use_memcache = False
+    scores = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+    @classmethod
+    def shard_keys(cls):
+        """Return the keys of all of the leaderboard shards"""
+        return [ndb.Key(cls, 'shard-%d' % i) for i in range(NUM_SHARDS)]
+
+    @classmethod
+    def add_score(cls, score):
+        """Offer a new score to a random shard; return the shard if
+        the score made it onto the leaderboard (the caller saves the
+        shard, normally in the same transaction as the score) or None
+        if it didn't"""
+        key = random.choice(cls.shard_keys())
+        shard = key.get() or cls(key=key)
+        if len(shard.scores) >= LEADERBOARD_SIZE and \
+                score.points <= shard.scores[-1].points:
+            return None
+        shard.scores.append(LeaderboardEntry.from_score(score))
+        shard.scores.sort(key=lambda s: s.points, reverse=True)
+        del shard.scores[LEADERBOARD_SIZE:]
+
+        # Drop the cached leaderboard once the shard has been saved
+        ndb.get_context().call_on_commit(cls.invalidate)
+        return shard
+
+    @classmethod
+    def top_scores(cls):
+        """Return the top LEADERBOARD_SIZE scores (highest first) as
+        LeaderboardEntry entities, from memcache if possible"""
+        version = cls.cache_version()
+        scores = memcache.get(MEMCACHE_LEADERBOARD % version)
+        if scores is None:
+            scores = []
+            for shard in ndb.get_multi(cls.shard_keys()):
+                if shard:
+                    scores.extend(shard.scores)
+            scores.sort(key=lambda s: s.points, reverse=True)
+            del scores[LEADERBOARD_SIZE:]
+            # If a shard changed after the version was read, the list
+            # is cached under a version that is no longer read
+            memcache.add(MEMCACHE_LEADERBOARD % version, scores,
+                         time=LEADERBOARD_CACHE_TIME)
+        return scores
+
+    @staticmethod
+    def cache_version():
+        """Return the version number of the cached leaderboard; a
+        missing version starts from the current time, so it doesn't
+        go back to the number of a leaderboard cached earlier"""
+        version = memcache.get(MEMCACHE_LEADERBOARD_VERSION)
+        if version is None:
+            memcache.add(MEMCACHE_LEADERBOARD_VERSION, int(time.time()))
+            version = memcache.get(MEMCACHE_LEADERBOARD_VERSION)
+        return version or 0
+
+    @staticmethod
+    def invalidate():
+        """Move the cached leaderboard on to a new version, so the
+        list cached until now is no longer read"""
+        memcache.incr(MEMCACHE_LEADERBOARD_VERSION,
+                      initial_value=int(time.time()))
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every shard from the Score entities in the
+        datastore"""
+        scores = fill_user_names(
+            Score.query().order(-Score.points).fetch(LEADERBOARD_SIZE))
+        shards = [cls(key=key) for key in cls.shard_keys()]
+        for i, score in enumerate(scores):
+            shards[i % NUM_SHARDS].scores.append(
+                LeaderboardEntry.from_score(score))
+        ndb.put_multi(shards)
+        cls.invalidate()
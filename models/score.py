@@ -13,19 +13,37 @@ from google.appengine.ext import ndb
 
 # Define score object
 class Score(ndb.Model):
-    """Score object"""
+    """Score object; only the properties used in queries (user,
+    time_completed and points) are indexed"""
+    # Scores are only ever read by queries, which don't use memcache
+    _use_memcache = False
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of the user's name (see Game.user_name)
+    user_name = ndb.StringProperty(indexed=False)
     time_completed = ndb.StringProperty(required=True)
-    won = ndb.BooleanProperty(required=True)
-    attempts_made = ndb.IntegerProperty(required=True)
-    game_deck = ndb.StringProperty(repeated=True)
-    matches_found = ndb.IntegerProperty(required=True)
+    won = ndb.BooleanProperty(required=True, indexed=False)
+    attempts_made = ndb.IntegerProperty(required=True, indexed=False)
+    game_deck = ndb.StringProperty(repeated=True, indexed=False)
+    matches_found = ndb.IntegerProperty(required=True, indexed=False)
     points = ndb.IntegerProperty(required=True)
 
+    @classmethod
+    def key_for_game(cls, game_key):
+        """Return the key of the score of a game; scores saved before
+        scores were keyed by their game have allocated ids instead"""
+        return ndb.Key(cls, 'game-%d' % game_key.id())
+
+    def get_user_name(self):
+        """Return the name of the score's user, looking the user up
+        only if the name hasn't been stored on the score"""
+        if self.user_name is None:
+            self.user_name = self.user.get().name
+        return self.user_name
+
     def to_form(self):
         """Return a ScoreForm representation of the score"""
         return ScoreForm(
-            user_name=self.user.get().name,
+            user_name=self.get_user_name(),
             won=self.won,
             time_completed=self.time_completed,
             attempts_made=self.attempts_made,
@@ -46,5 +64,7 @@ class ScoreForm(messages.Message):
     points = messages.IntegerField(7, required=True, default=0)
 
 class ScoreForms(messages.Message):
-    """Outbound container for a list of ScoreForm forms"""
+    """Outbound container for a list of ScoreForm forms; next_cursor
+    is used to request the next page of scores"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+
+"""
+The stats.py file defines the ActiveGameStatsShard model, which keeps
+running totals for all active games (games that are neither over nor
+cancelled): the number of active games and the sum of their attempts
+remaining. The get_average_attempts_remaining endpoint divides one by
+the other.
+
+The totals are split across NUM_SHARDS entities so that many games can
+update them at once; each update goes to a shard chosen at random and
+the totals are read by adding up every shard.
+
+"""
+
+
+import random
+
+from google.appengine.ext import ndb
+
+
+NUM_SHARDS = 20
+
+
+# Define active game stats object
+class ActiveGameStatsShard(ndb.Model):
+    """One shard of the active game totals"""
+    # The shards are written on every move but only read when the
+    # average is recalculated, so keeping them in memcache would only
+    # add memcache calls to each move
+    _use_memcache = False
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls):
+        """Return the keys of all of the shards"""
+        return [ndb.Key(cls, 'shard-%d' % i) for i in range(NUM_SHARDS)]
+
+    @classmethod
+    def shard_for_update(cls, games=0, attempts_remaining=0):
+        """Add to the totals of a random shard and return the shard;
+        the caller saves the shard, normally in the same transaction
+        as the game that changed"""
+        key = random.choice(cls.shard_keys())
+        shard = key.get() or cls(key=key)
+        shard.games += games
+        shard.attempts_remaining += attempts_remaining
+        return shard
+
+    @classmethod
+    @ndb.transactional
+    def increment(cls, games=0, attempts_remaining=0):
+        """Add to the totals of a random shard and save it"""
+        cls.shard_for_update(games, attempts_remaining).put()
+
+    @classmethod
+    def totals(cls):
+        """Return the number of active games and the sum of their
+        attempts remaining"""
+        games = attempts_remaining = 0
+        for shard in ndb.get_multi(cls.shard_keys()):
+            if shard:
+                games += shard.games
+                attempts_remaining += shard.attempts_remaining
+        return games, attempts_remaining
+
+    @classmethod
+    def rebuild(cls, games, attempts_remaining):
+        """Replace the totals (e.g. with totals counted from the
+        Game entities); everything is stored on the first shard"""
+        shards = [cls(key=key) for key in cls.shard_keys()]
+        shards[0].games = games
+        shards[0].attempts_remaining = attempts_remaining
+        ndb.put_multi(shards)
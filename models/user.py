@@ -10,17 +10,72 @@ Add docstring
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from models.user_name import UserName
+
+
+# Users created before UserName was added are found with a query on
+# User.name (their UserName entities are created by the
+# MigrateUserNames task, not by the lookups); set NAME_QUERY_FALLBACK
+# to False once the MigrateUserNames task (see main.py) has run, so
+# that looking up a name that isn't taken doesn't need a query
+NAME_QUERY_FALLBACK = True
+
 
 # Define user object
 class User(ndb.Model):
-    """User profile"""
+    """User profile; only the properties used in queries (name,
+    total_points and points_per_attempt) are indexed"""
+    # Users are read by key (e.g. at the end of every move), so they
+    # are kept in the in-context cache and in memcache
+    _use_cache = True
+    _use_memcache = True
     name = ndb.StringProperty(required=True)
-    email = ndb.StringProperty()
-    games_played = ndb.IntegerProperty(required=True)
-    total_attempts = ndb.IntegerProperty(required=True)
+    email = ndb.StringProperty(indexed=False)
+    games_played = ndb.IntegerProperty(required=True, indexed=False)
+    total_attempts = ndb.IntegerProperty(required=True, indexed=False)
     total_points = ndb.IntegerProperty(required=True)
     points_per_attempt = ndb.IntegerProperty(required=True)
 
+    @classmethod
+    def get_by_name(cls, name):
+        """Return the user with the given name (None if there isn't
+        one); the name is looked up by key (see models/user_name.py)
+
+        Names that differ only in case are the same name, but users
+        created before UserName was added may have such names; until
+        the MigrateUserNames task has run, a name spelled differently
+        from the user its UserName points to is also looked up with a
+        query on its exact spelling, so that each of those users is
+        still found by their own name. The lookup never writes to the
+        datastore"""
+        user_name = UserName.key_for(name).get()
+        user = user_name.user.get() if user_name is not None else None
+        if not NAME_QUERY_FALLBACK or (user is not None and
+                                       user.name == name):
+            return user
+        legacy_user = cls.query(cls.name == name).get()
+        return legacy_user if legacy_user is not None else user
+
+    @classmethod
+    def get_by_names(cls, names):
+        """Return the user with each of the given names (None for a
+        name that isn't taken); the names are looked up with batch
+        gets rather than one get per name"""
+        user_names = ndb.get_multi([UserName.key_for(name)
+                                    for name in names])
+        found = iter(ndb.get_multi([user_name.user
+                                    for user_name in user_names
+                                    if user_name is not None]))
+        users = []
+        for name, user_name in zip(names, user_names):
+            user = next(found) if user_name is not None else None
+            # Names that aren't taken, or that are spelled differently
+            # from their user's name, are looked up as get_by_name does
+            if user is None or (NAME_QUERY_FALLBACK and user.name != name):
+                user = cls.get_by_name(name)
+            users.append(user)
+        return users
+
     def to_rankings_form(self):
         """Return a UserRanking representation of the User"""
         return UserRanking(
@@ -42,8 +97,10 @@ class UserRanking(messages.Message):
     points_per_attempt = messages.IntegerField(5, required=True)
 
 class UserRankings(messages.Message):
-    """Outbound container for a list of UserRanking forms"""
+    """Outbound container for a list of UserRanking forms; next_cursor
+    is used to request the next page of rankings"""
     items = messages.MessageField(UserRanking, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class StringMessage(messages.Message):
     """A single outbound string message"""
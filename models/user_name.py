@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+
+"""
+The user_name.py file defines the UserName model, which makes user
+names unique and lets a user be found by name with a key get (which
+is strongly consistent) rather than a query on User.name (which is
+eventually consistent). Each UserName entity is keyed by a normalized
+user name (see normalize) and points to the User with that name.
+
+"""
+
+
+from google.appengine.ext import ndb
+
+
+# Define user name object
+class UserName(ndb.Model):
+    """Maps a normalized user name (the key's id) to its User"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+    @staticmethod
+    def normalize(name):
+        """Return the form of a user name used as a key; names that
+        differ only in case or surrounding spaces are the same name"""
+        return name.strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Return the key of the UserName entity for a user name"""
+        return ndb.Key(cls, cls.normalize(name))
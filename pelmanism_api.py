@@ -2,53 +2,77 @@
 
 
 """
-The Pelmanism API is made up of 12 endpoints, and these are built and
+The Pelmanism API is made up of 15 endpoints, and these are built and
 configured in pelmanism_api.py.
 
-The endpoints are as follows: create_user, new_game, get_game,
-make_move, get_scores, get_user_scores, get_average_attempts_remaining,
-get_user_games, cancel_game, get_high_scores, get_user_rankings,
-get_game_history.
+The endpoints are as follows: create_user, new_game, new_games,
+get_game, make_move, make_moves, get_scores, get_user_scores,
+get_average_attempts_remaining, get_user_games, cancel_game,
+get_high_scores, get_user_rankings, get_game_history, replay_game.
 
 The class definitions for the Google Datastore entities used by
-Pelmanism are defined in the models package, and the game_logic.py
-file contains several functions used in the make_move endpoint.
+Pelmanism are defined in the models package. The rules of the game
+are in engine.py, and the game_logic.py file adapts them to the
+models for the make_move, make_moves and replay_game endpoints.
 
 """
 
 
 import logging
+import random
+import time
 import endpoints
 
 from protorpc import remote, messages
 
-from google.appengine.api import memcache, taskqueue
+from google.appengine.api import datastore_errors, memcache, taskqueue
 from google.appengine.ext import ndb
 
 from models.user import User, UserRankings, StringMessage
+from models.user_name import UserName
 from models.game import (Game,
                          GameForm,
                          GameForms,
                          NewGameForm,
+                         NewGamesForm,
+                         GameKeyForm,
+                         GameKeyForms,
                          MakeMoveForm,
+                         MakeMovesForm,
+                         FlipForm,
+                         FlipForms,
                          ScoreForms,
                          GameHistory,
+                         ReplayForm,
                          StringMessage)
 from models.guess1 import Guess1
 from models.score import Score, ScoreForms
+from models.leaderboard import LeaderboardShard
+from models.stats import ActiveGameStatsShard
 
 import game_logic
+from rpc_stats import instrument
 
-from utils import get_by_urlsafe
+from utils import (get_by_urlsafe,
+                   fetch_page,
+                   page_list,
+                   fill_user_names)
 
 
 # Define global variables
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+REPLAY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    move=messages.IntegerField(2))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
@@ -56,8 +80,28 @@ CANCEL_GAME = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     urlsafe_game_key=messages.StringField(2))
 HIGH_SCORES = endpoints.ResourceContainer(
-    number_of_results=messages.IntegerField(1))
+    number_of_results=messages.IntegerField(1),
+    cursor=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    cursor=messages.StringField(1),
+    page_size=messages.IntegerField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    cursor=messages.StringField(2),
+    page_size=messages.IntegerField(3))
+# The largest number of games created by new_games in one call
+MAX_GAMES_PER_REQUEST = 1000
+# The largest number of guesses accepted by make_moves in one call
+MAX_GUESSES_PER_REQUEST = 100
 MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+# The average attempts remaining is recalculated at most once per
+# AVERAGE_ATTEMPTS_INTERVAL seconds; the memcache counters record how
+# many refreshes were scheduled and how many requests were collapsed
+# into an already scheduled refresh
+AVERAGE_ATTEMPTS_INTERVAL = 10
+MEMCACHE_AVERAGE_ATTEMPTS_WINDOW = 'AVERAGE_ATTEMPTS_WINDOW_%d'
+MEMCACHE_AVERAGE_ATTEMPTS_SCHEDULED = 'AVERAGE_ATTEMPTS_SCHEDULED'
+MEMCACHE_AVERAGE_ATTEMPTS_COLLAPSED = 'AVERAGE_ATTEMPTS_COLLAPSED'
 
 
 # Define the endpoints class for the API
@@ -74,71 +118,161 @@ class PelmanismApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrument
     def create_user(self, request):
-        """Create a user; a unique user name is required"""
-        if User.query(User.name == request.user_name).get():
+        """Create a user; a unique user name is required (names that
+        differ only in case are the same name, but a user created
+        before UserName was added is only found by the exact spelling
+        of their name until the MigrateUserNames task has run)"""
+        if User.get_by_name(request.user_name):
             raise endpoints.ConflictException(
                 'A user with that name already exists.')
-        user = User(name=request.user_name, email=request.email,
-                    games_played=0, total_attempts=0, total_points=0,
-                    points_per_attempt=0)
-        user.put()
+        self._create_user(request.user_name, request.email)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _create_user(user_name, email):
+        """Create a user and claim its name in one transaction, so
+        that two requests can't create users with the same name;
+        return the user"""
+        name_key = UserName.key_for(user_name)
+        if name_key.get():
+            raise endpoints.ConflictException(
+                'A user with that name already exists.')
+        user = User(name=user_name, email=email, games_played=0,
+                    total_attempts=0, total_points=0, points_per_attempt=0)
+        user.put()
+        UserName(key=name_key, user=user.key).put()
+        return user
+
     # NEW GAME endpoint ---
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrument
     def new_game(self, request):
         """Create a new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A user with that name does not exist!')
 
-        # Set up game variables
-        deck = game_logic.deck_creation()
-        disp_deck = ['_' for x in range(len(deck))]
+        # Set up game variables; the seed is kept with the game so the
+        # deck can be recreated
+        seed = random.getrandbits(32)
+        try:
+            deck = game_logic.deck_creation(request.pairs, seed)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
         attempts_made = 0
-        match_list = []
-        match_list_int = []
         matches_found = 0
         guess1_or_guess2 = 0
         guess_history = []
 
         # Attempt to create a new game object
         try:
-            game = Game.new_game(
+            game = Game.build(
                 user.key,
                 request.attempts,
                 deck,
-                disp_deck,
                 attempts_made,
-                match_list,
-                match_list_int,
                 matches_found,
                 guess1_or_guess2,
-                guess_history)
-        except ValueError:
-            raise endpoints.BadRequestException(
-                'Number of attempts must be more than 29 and less than 61')
-
-        # Update the number of attempts remaining with a task queue
-        taskqueue.add(url='/tasks/cache_average_attempts')
+                guess_history,
+                user_name=user.name,
+                seed=seed)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+        # Save the game and add it to the active game totals in one
+        # transaction, then update the average attempts remaining with
+        # a task queue
+        self._save_new_game(game)
+        self._schedule_average_attempts()
 
         # Call the to_form() function, which fills in GameForm
         # We pass in what will be the message as the argument
         return game.to_form('Good luck playing Pelmanism!')
 
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _save_new_game(game):
+        """Save a new game and add it to the active game totals in one
+        transaction"""
+        ndb.put_multi([game, ActiveGameStatsShard.shard_for_update(
+            1, game.attempts_remaining)])
+
+    # NEW GAMES endpoint ---
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameKeyForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrument
+    def new_games(self, request):
+        """Create games in bulk (e.g. at the start of a tournament):
+        games_per_user games for each user named in the request; all
+        of the games are saved at once; return the key of each game"""
+        if not request.user_names:
+            raise endpoints.BadRequestException('No user names were sent.')
+        total = len(request.user_names) * request.games_per_user
+        if request.games_per_user < 1 or total > MAX_GAMES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'Between 1 and %d games can be created at once.'
+                % MAX_GAMES_PER_REQUEST)
+        users = User.get_by_names(request.user_names)
+        missing = [name for name, user in zip(request.user_names, users)
+                   if user is None]
+        if missing:
+            raise endpoints.NotFoundException(
+                'These users do not exist: %s' % ', '.join(missing))
+
+        games = []
+        try:
+            for user in users:
+                for _ in range(request.games_per_user):
+                    seed = random.getrandbits(32)
+                    games.append(Game.build(
+                        user.key,
+                        request.attempts,
+                        game_logic.deck_creation(request.pairs, seed),
+                        0, 0, 0, [],
+                        user_name=user.name,
+                        seed=seed))
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        ndb.put_multi(games)
+
+        # Add the games to the active game totals in one update and
+        # schedule (at most) one update of the average attempts
+        # remaining; a transaction can't span more than 25 entity
+        # groups, so the games can't be saved with the shard, and if
+        # the update fails the totals are recounted by a task instead
+        try:
+            ActiveGameStatsShard.increment(
+                len(games), sum(game.attempts_remaining for game in games))
+        except datastore_errors.Error:
+            logging.exception('The active game totals were not updated '
+                              'for %d new games', len(games))
+            taskqueue.add(url='/tasks/rebuild_active_game_stats')
+        self._schedule_average_attempts()
+
+        return GameKeyForms(items=[
+            GameKeyForm(urlsafe_key=game.key.urlsafe(),
+                        user_name=game.user_name)
+            for game in games])
+
     # GET GAME endpoint ---
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrument
     def get_game(self, request):
         """Return the current state of an active game"""
         # Check to see if the urlsafe_game_key matches a game
@@ -159,195 +293,288 @@ class PelmanismApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='POST')
+    @instrument
     def make_move(self, request):
         """Make a move (or an attempt); this consists of two guesses,
         meaning that a user must call the make_move endpoint twice in
         order to make a move; at the conclusion of the move,
         return a game state with message"""
-        # Set up variables for making the first and second guesses
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        user = User.query(game.user == User.key).get()
-        deck = game.deck
-        # A list of the integers that correspond to each card that
-        # has been matched
-        mli = game.match_list_int
-        # A list of card values (e.g. 'B' or 'H') that have been matched
-        match_list = game.match_list
-
-        # FIRST GUESS
-        # The guess1_or_guess2 property is used to determine if the player
-        # is flipping over their first or second card of the move
-        if game.guess1_or_guess2 % 2 == 0:
-
-            # Retrieve the Guess1 model for this game and delete
-            # the previous entities (this ensures only the most recent
-            # guess1 is in the database, thus simplifying the second guess)
-            guess1_old = Guess1.query(ancestor=game.key).get()
-            if guess1_old is not None:
-                guess1_old.key.delete()
-
-            # Set up a variable for the integer representing the card
-            guess1_int = request.guess
-
-            # Reset the deck (make sure all cards are turned over)
-            game_logic.reset_deck(game.disp_deck, mli)
+        game, outcomes, error = self._make_moves(
+            request.urlsafe_game_key, [request.guess])
+        if error is not None:
+            # A game that is over or cancelled is returned as it is
+            if game.game_over or game.cancelled:
+                return game.to_form(error)
+            raise endpoints.BadRequestException(error)
+        _, _, message, revealed = outcomes[0]
+        return game.to_form(message, revealed)
+
+    # MAKE MOVES endpoint ---
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=FlipForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrument
+    def make_moves(self, request):
+        """Make a number of guesses (e.g. both guesses of a move, or
+        several moves) in one call; the guesses are made in order until
+        one can't be made; return the outcome of each guess and the
+        final game state"""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses were sent.')
+        if len(request.guesses) > MAX_GUESSES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'No more than %d guesses can be made at once.'
+                % MAX_GUESSES_PER_REQUEST)
+        game, outcomes, error = self._make_moves(
+            request.urlsafe_game_key, request.guesses)
+
+        items = [FlipForm(guess=guess, made=True, card=card,
+                          message=message)
+                 for guess, card, message, _ in outcomes]
+        if error is not None:
+            items.append(FlipForm(guess=request.guesses[len(outcomes)],
+                                  made=False, message=error))
+            return FlipForms(items=items, game=game.to_form(error))
+        _, _, message, revealed = outcomes[-1]
+        return FlipForms(items=items, game=game.to_form(message, revealed))
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _make_moves(urlsafe_game_key, guesses):
+        """Apply guesses to a game in order, stopping at the first one
+        that can't be made; the game is read and written (along with
+        the user, the active game totals and, at the end of a game, the
+        score and the leaderboard) once, in one cross-group
+        transaction, so that concurrent guesses can't overwrite each
+        other; return the game, a (guess, card, message, revealed)
+        tuple for each guess made (revealed is the positions of the
+        cards to show face up, or None for the default of
+        Game.display_deck) and the reason the next guess couldn't be
+        made (None if every guess was made)"""
+        game = get_by_urlsafe(urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
 
+        # Games started before the first guess of a move was stored on
+        # the game keep it in a Guess1 child entity; if that is missing
+        # (e.g. it was deleted by MigrateGuess1 before the game was
+        # updated), the first card is dropped and the game is treated
+        # as being between moves
+        legacy_guess1 = None
+        if game.guess1_or_guess2 % 2 == 1 and game.pending_guess is None:
+            legacy_guess1 = Guess1.query(ancestor=game.key).get()
+            if legacy_guess1 is not None:
+                game.pending_guess = legacy_guess1.guess1_int
+            else:
+                logging.warning('Game %s has no Guess1 entity; its first '
+                                'card was dropped', urlsafe_game_key)
+                game.guess1_or_guess2 += 1
+
+        outcomes = []
+        error = None
+        user = score = None
+        games_change = attempts_change = 0
+        for guess in guesses:
             # Check to see if the game is over or cancelled
             if game.game_over:
-                return game.to_form('The game is already over!')
+                error = 'The game is already over!'
+                break
             if game.cancelled:
-                return game.to_form('The game has been cancelled!')
-
-            # Handle a guess error
-            game_logic.guess_error(guess1_int, mli)
-
-            # Convert guess_int into a string variable containing
-            # the actual card value (i.e. a letter, rather than a num)
-            guess1 = deck[guess1_int]
-
-            # Display the deck with the chosen card flipped over
-            game.disp_deck[guess1_int] = guess1
-
-            # Add the guess into the database, making game.key the parent
-            guess1_db = Guess1(parent=game.key,
-                               guess1=guess1,
-                               guess1_int=guess1_int)
-            guess1_db.put()
-
-            game.guess1_or_guess2 += 1
-            game.put()
-            return game.to_form(
-                'You turned over a %s. Turn over another card.' % guess1)
-
-        # SECOND GUESS
-        else:
-            # Retrieve the guess1 model that matches this game
-            # (this is done to check for a match later)
-            guess1 = Guess1.query(ancestor=game.key).get()
-
-            # Set up a variable for the integer representing the card
-            guess2_int = request.guess
-
-            # Handle a guess error
-            game_logic.guess_error(guess2_int, mli)
-
-            game.attempts_remaining -= 1
-            game.attempts_made += 1
-            game.guess1_or_guess2 += 1
+                error = 'The game has been cancelled!'
+                break
+
+            # Turn the card over
+            try:
+                flip = game_logic.apply_flip(game, guess)
+            except endpoints.BadRequestException as e:
+                error = str(e)
+                break
+            msg = 'You turned over a %s. ' % flip.card
+
+            # FIRST GUESS
+            if flip.first_index is None:
+                outcomes.append(
+                    (guess, flip.card, msg + 'Turn over another card.',
+                     None))
+                continue
+
+            # SECOND GUESS
+            # Queries aren't allowed in a cross-group transaction, so
+            # look the user up by key
+            if user is None:
+                user = game.user.get()
+                if game.user_name is None:
+                    game.user_name = user.name
             user.total_attempts += 1
 
-            # Convert guess2_int into a string variable containing
-            # the actual card value (i.e. a letter, rather than a num)
-            guess2 = deck[guess2_int]
-            msg = 'You turned over a %s. ' % guess2
-
-            # Display the deck with the chosen card flipped over
-            game.disp_deck[guess2_int] = guess2
-
-            # Return an error if the same card was picked twice
-            if guess1.guess1_int == guess2_int:
-                raise endpoints.BadRequestException(
-                    msg + 'You can\'t pick the same card twice!')
-
-            # Determine if a match was found
-            if guess1.guess1 == guess2:
-                match_list.extend(guess1.guess1)
-                match_list.extend(guess2)
-                mli.append(guess1.guess1_int)
-                mli.append(guess2_int)
-                game.matches_found += 1
+            if flip.match:
                 match_msg = 'You found a match!'
-
             else:
                 match_msg = 'Sorry, you didn\'t find a match.'
 
             # Determine if the game is over
-            won_lost_msg = game_logic.won_or_lost(game, user,
-                                                  guess1.guess1, guess2)
+            won_lost_msg, game_score = game_logic.won_or_lost(
+                game, user, flip)
             # If the game is over, add up the points scored
             game_logic.points(
                 game, game.attempts_made, game.matches_found, user)
-
-            game.put()
-            user.put()
-            return game.to_form(msg + match_msg + won_lost_msg)
+            if game.game_over:
+                # The game no longer counts as active
+                score = game_score
+                games_change -= 1
+                attempts_change -= game.attempts_remaining + 1
+            else:
+                attempts_change -= 1
+            # Both cards of the move stay face up until the next move
+            outcomes.append((guess, flip.card,
+                             msg + match_msg + won_lost_msg,
+                             [flip.first_index, flip.index]))
+
+        if not outcomes:
+            return game, outcomes, error
+
+        # Write the game, the user, the active game totals and (if the
+        # game is over) the score and the leaderboard in a single batch
+        entities = [game]
+        if user is not None:
+            entities.append(user)
+            entities.append(ActiveGameStatsShard.shard_for_update(
+                games_change, attempts_change))
+        if score is not None:
+            entities.append(score)
+            leaderboard_shard = LeaderboardShard.add_score(score)
+            if leaderboard_shard is not None:
+                entities.append(leaderboard_shard)
+        ndb.put_multi(entities)
+        if legacy_guess1 is not None:
+            legacy_guess1.key.delete()
+        return game, outcomes, error
 
     # GET SCORES endpoint ---
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrument
     def get_scores(self, request):
-        """Return all scores ordered by time_completed"""
-        return ScoreForms(
-            items=[score.to_form() for score in Score.query(
-            ).order(-Score.time_completed)])
+        """Return a page of scores ordered by time_completed"""
+        scores, next_cursor = fetch_page(
+            Score.query().order(-Score.time_completed),
+            request.cursor, request.page_size)
+        fill_user_names(scores)
+        return ScoreForms(items=[score.to_form() for score in scores],
+                          next_cursor=next_cursor)
 
     # GET USER SCORES endpoint ---
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrument
     def get_user_scores(self, request):
-        """Return all of an individual user's scores ordered by points"""
-        user = User.query(User.name == request.user_name).get()
+        """Return a page of an individual user's scores ordered
+        by points"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A user with that name does not exist!')
-        scores = Score.query(Score.user == user.key).order(-Score.points)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_cursor = fetch_page(
+            Score.query(Score.user == user.key).order(-Score.points),
+            request.cursor, request.page_size)
+        # All of the scores belong to the same user
+        for score in scores:
+            score.user_name = user.name
+        return ScoreForms(items=[score.to_form() for score in scores],
+                          next_cursor=next_cursor)
 
     # GET AVERAGE ATTEMPTS endpoint ---
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrument
     def get_average_attempts(self, request):
         """Return the cached average attempts (or moves) remaining
         for all active games"""
-        return StringMessage(message=memcache.get(
-            MEMCACHE_MOVES_REMAINING) or '')
+        message = memcache.get(MEMCACHE_MOVES_REMAINING)
+        if message is None:
+            message = PelmanismApi._cache_average_attempts()
+        return StringMessage(message=message)
 
     @staticmethod
     def _cache_average_attempts():
         """Populate the memcache with the average attempts (or
-        moves) remaining"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                            for game in games])
+        moves) remaining; the average is worked out from the sharded
+        active game totals, so this doesn't depend on the number of
+        games; return the cached message"""
+        count, total_attempts_remaining = ActiveGameStatsShard.totals()
+        if count > 0:
             average = float(total_attempts_remaining) / count
-            memcache.set(
-                MEMCACHE_MOVES_REMAINING,
-                'The average moves remaining is {:.2f}'.format(average))
+            message = 'The average moves remaining is {:.2f}'.format(average)
+        else:
+            message = ''
+        memcache.set(MEMCACHE_MOVES_REMAINING, message)
+        return message
+
+    @staticmethod
+    def _schedule_average_attempts():
+        """Schedule a task to update the average attempts (or moves)
+        remaining; requests in the same AVERAGE_ATTEMPTS_INTERVAL
+        window share a single task, which runs at the end of the
+        window"""
+        now = time.time()
+        window = int(now) // AVERAGE_ATTEMPTS_INTERVAL
+        # memcache.add fails if another request already claimed the
+        # window, which saves a taskqueue call; the task name catches
+        # the cases memcache misses (e.g. an evicted key)
+        claimed = memcache.add(MEMCACHE_AVERAGE_ATTEMPTS_WINDOW % window,
+                               True, time=AVERAGE_ATTEMPTS_INTERVAL * 2)
+        if claimed:
+            try:
+                taskqueue.add(
+                    url='/tasks/cache_average_attempts',
+                    name='cache-average-attempts-%d' % window,
+                    countdown=(window + 1) * AVERAGE_ATTEMPTS_INTERVAL - now)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                claimed = False
+        if claimed:
+            memcache.incr(MEMCACHE_AVERAGE_ATTEMPTS_SCHEDULED,
+                          initial_value=0)
+        else:
+            memcache.incr(MEMCACHE_AVERAGE_ATTEMPTS_COLLAPSED,
+                          initial_value=0)
 
     # GET USER GAMES endpoint ---
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='game/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrument
     def get_user_games(self, request):
-        """Return a user's active games ordered by the time each game
-        was created"""
-        user = User.query(User.name == request.user_name).get()
+        """Return a page of a user's active games ordered by the time
+        each game was created"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A user with that name does not exist!')
-        # Get a list of all of a user's games
-        games = Game.query(
-            Game.user == user.key).order(-Game.time_created).fetch()
-
-        # Filter out completed and cancelled games; return what's left
-        game_lst = []
+        # Completed and cancelled games are filtered out by the
+        # datastore (see the matching index in index.yaml)
+        games, next_cursor = fetch_page(
+            Game.query(Game.user == user.key,
+                       Game.game_over == False,
+                       Game.cancelled == False).order(-Game.time_created),
+            request.cursor, request.page_size)
         for g in games:
-            if not g.game_over:
-                if not g.cancelled:
-                    game_lst.append(g)
+            g.user_name = user.name
         return GameForms(
-            items=[g.to_form_user_games() for g in game_lst])
+            items=[g.to_form_user_games() for g in games],
+            next_cursor=next_cursor)
 
     # CANCEL GAME endpoint ---
     @endpoints.method(request_message=CANCEL_GAME,
@@ -355,22 +582,35 @@ class PelmanismApi(remote.Service):
                       path='game/{urlsafe_game_key}/user/{user_name}',
                       name='cancel_game',
                       http_method='POST')
+    @instrument
     def cancel_game(self, request):
         """Cancel a game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A user with that name does not exist!')
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._cancel_game(request.urlsafe_game_key, user.key)
+        return game.to_form('Game cancelled')
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _cancel_game(urlsafe_game_key, user_key):
+        """Mark a game as cancelled and remove it from the active game
+        totals in one transaction; return the game"""
+        game = get_by_urlsafe(urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
             raise endpoints.BadRequestException(
                 'Sorry, you can\'t delete a completed game.')
-        if user.key != game.user:
+        if user_key != game.user:
             raise endpoints.BadRequestException(
                 'Sorry, you\'re not authorized to cancel this game.')
-        game.cancelled = True
-        game.put()
-        return game.to_form('Game cancelled')
+        if not game.cancelled:
+            game.cancelled = True
+            ndb.put_multi([game, ActiveGameStatsShard.shard_for_update(
+                -1, -game.attempts_remaining)])
+        return game
 
     # GET HIGH SCORES endpoint ---
     @endpoints.method(request_message=HIGH_SCORES,
@@ -378,30 +618,38 @@ class PelmanismApi(remote.Service):
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrument
     def get_high_scores(self, request):
-        """Return all scores ordered by points; an optional parameter
-        (number_of_results) limits the number of results returned"""
-        num = request.number_of_results
-        if num:
-            scores = Score.query().order(-Score.points).fetch(num)
-        else:
-            scores = Score.query().order(-Score.points).fetch()
+        """Return a page of the top scores ordered by points; an
+        optional parameter (number_of_results) sets the number of
+        results returned; the scores are read from the precomputed
+        leaderboard"""
+        scores, next_cursor = page_list(
+            LeaderboardShard.top_scores(),
+            request.cursor, request.number_of_results)
+        fill_user_names(scores)
         return ScoreForms(
-            items=[score.to_form() for score in scores])
+            items=[score.to_form() for score in scores],
+            next_cursor=next_cursor)
 
     # GET USER RANKINGS endpoint ---
-    @endpoints.method(response_message=UserRankings,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserRankings,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrument
     def get_user_rankings(self, request):
-        """Return a list of users ranked by points_per_attempt
+        """Return a page of users ranked by points_per_attempt
         (points_per_attempt is determined by total_points /
         total_attempts); a tie is broken by total_points"""
-        u_rankings = User.query().order(
-            -User.points_per_attempt, -User.total_points).fetch()
+        u_rankings, next_cursor = fetch_page(
+            User.query().order(
+                -User.points_per_attempt, -User.total_points),
+            request.cursor, request.page_size)
         return UserRankings(
-            items=[user.to_rankings_form() for user in u_rankings])
+            items=[user.to_rankings_form() for user in u_rankings],
+            next_cursor=next_cursor)
 
     # GET GAME HISTORY endpoint ---
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -409,6 +657,7 @@ class PelmanismApi(remote.Service):
                       path='game_history',
                       name='get_game_history',
                       http_method='GET')
+    @instrument
     def get_game_history(self, request):
         """Return a list of guesses made throughout the course of
         a completed game as well as the end result of the game"""
@@ -426,6 +675,33 @@ class PelmanismApi(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    # REPLAY GAME endpoint ---
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=ReplayForm,
+                      path='game_replay',
+                      name='replay_game',
+                      http_method='GET')
+    @instrument
+    def replay_game(self, request):
+        """Replay a game from its starting deck and return the state
+        of the game after a given move (after the last move by
+        default)"""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.moves is None:
+            raise endpoints.BadRequestException(
+                'This game was started before moves were recorded and '
+                'can\'t be replayed.')
+        total_moves = len(game.moves)
+        move = total_moves if request.move is None else request.move
+        if move < 0 or move > total_moves:
+            raise endpoints.BadRequestException(
+                'Move must be between 0 and %d' % total_moves)
+        state = game_logic.replay(game, move)
+        return game.to_form_replay(
+            state, move, 'Move %d of %d' % (move, total_moves))
+
 
 # Start the API server
 api = endpoints.api_server([PelmanismApi])
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+
+"""
+The rpc_stats.py file measures calls to the endpoints of the API. The
+endpoints in pelmanism_api.py are decorated with instrument(), which
+records, for a sample of the calls (see SAMPLE_RATE):
+
+ - the wall time of the call
+ - the datastore RPCs made, as gets, puts, queries and deletes and by
+   method (e.g. datastore_v3.Get or memcache.Set)
+ - memcache hits and misses
+ - the bytes of entities written and the size of the response
+
+Each call's record is logged as one line of JSON, starting with
+LOG_PREFIX, so the records can be found and parsed in the request
+logs, and is passed to each of the SINKS. On the development server,
+a sink adds the records up for each endpoint (see totals()) so that
+tools/load_test.py can read them through the RpcStats handler in
+main.py; these totals are kept in memory, so they only cover the
+instance that handled the requests. Set STATSD_ADDRESS to also send
+the records to a local StatsD server.
+
+RPCs are counted with API proxy hooks, so every RPC is counted,
+including those made by ndb itself (e.g. to keep memcache up to date).
+RPCs served from ndb's in-context cache are never sent, so they aren't
+counted. Calls that aren't sampled skip all of the measuring.
+
+"""
+
+
+import functools
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+from protorpc import protojson
+from google.appengine.api import apiproxy_stub_map
+
+
+DEVELOPMENT = os.environ.get('SERVER_SOFTWARE', '').startswith(
+    'Development')
+# The fraction of endpoint calls that are measured; every call is
+# measured on the development server
+SAMPLE_RATE = 1.0 if DEVELOPMENT else 0.1
+LOG_PREFIX = 'endpoint_stats'
+# The (host, port) of a StatsD server to send the records to, or None
+STATSD_ADDRESS = None
+STATSD_PREFIX = 'pelmanism'
+
+SERVICES = ('datastore_v3', 'memcache')
+# The datastore methods counted as gets, puts, queries and deletes
+DATASTORE_GROUPS = {'Get': 'gets', 'Put': 'puts', 'RunQuery': 'queries',
+                    'Next': 'queries', 'Delete': 'deletes'}
+# The numbers in a record that are added up by the sinks
+COUNTERS = ('gets', 'puts', 'queries', 'deletes', 'memcache_hits',
+            'memcache_misses', 'write_bytes', 'response_bytes')
+
+# Requests may be handled in parallel threads (threadsafe is set in
+# app.yaml), so each thread keeps its own counts
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def _count_rpc(service, call, request, response):
+    """API proxy hook that counts an RPC for the current request"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        name = '%s.%s' % (service, call)
+        stats['rpcs'][name] = stats['rpcs'].get(name, 0) + 1
+        if service == 'datastore_v3' and call == 'Put':
+            stats['write_bytes'] += sum(
+                entity.ByteSize() for entity in request.entity_list())
+
+
+def _count_memcache_hits(service, call, request, response):
+    """API proxy hook that counts the hits and misses of a memcache
+    get once its response has arrived"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None and call == 'Get':
+        hits = response.item_size()
+        stats['memcache_hits'] += hits
+        stats['memcache_misses'] += request.key_size() - hits
+
+
+for _service in SERVICES:
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_stats_' + _service, _count_rpc, _service)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'rpc_stats_memcache_hits', _count_memcache_hits, 'memcache')
+
+
+def _record(name, stats, seconds, response, error):
+    """Return the record of an endpoint call"""
+    record = dict((group, 0) for group in DATASTORE_GROUPS.values())
+    for rpc, count in stats['rpcs'].items():
+        service, call = rpc.split('.', 1)
+        if service == 'datastore_v3' and call in DATASTORE_GROUPS:
+            record[DATASTORE_GROUPS[call]] += count
+    record.update(
+        endpoint=name,
+        wall_ms=round(seconds * 1000, 1),
+        rpcs=stats['rpcs'],
+        memcache_hits=stats['memcache_hits'],
+        memcache_misses=stats['memcache_misses'],
+        write_bytes=stats['write_bytes'],
+        response_bytes=len(protojson.encode_message(response))
+        if response is not None else 0,
+        error=error)
+    return record
+
+
+def instrument(func):
+    """Decorator for an endpoint method that measures a sample of its
+    calls (see SAMPLE_RATE), logs each record and passes it to the
+    SINKS"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if random.random() >= SAMPLE_RATE:
+            return func(*args, **kwargs)
+        _local.stats = {'rpcs': {}, 'write_bytes': 0,
+                        'memcache_hits': 0, 'memcache_misses': 0}
+        start = time.time()
+        response = error = None
+        try:
+            response = func(*args, **kwargs)
+            return response
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            stats, _local.stats = _local.stats, None
+            record = _record(func.__name__, stats, time.time() - start,
+                             response, error)
+            logging.info('%s %s', LOG_PREFIX,
+                         json.dumps(record, sort_keys=True))
+            for sink in SINKS:
+                try:
+                    sink(record)
+                except Exception:
+                    logging.exception('Metrics sink %r failed', sink)
+    return wrapper
+
+
+def totals():
+    """Return the totals recorded for each endpoint since the last
+    reset: the number of calls, the total wall time, the RPCs by
+    service and method and the sum of each of the COUNTERS"""
+    with _totals_lock:
+        return dict((name, dict(total, rpcs=dict(total['rpcs'])))
+                    for name, total in _totals.items())
+
+
+def reset_totals():
+    """Clear the totals recorded for every endpoint"""
+    with _totals_lock:
+        _totals.clear()
+
+
+def add_to_totals(record):
+    """Sink that adds a record to the totals of its endpoint"""
+    with _totals_lock:
+        total = _totals.get(record['endpoint'])
+        if total is None:
+            total = _totals[record['endpoint']] = dict(
+                ((counter, 0) for counter in COUNTERS),
+                calls=0, wall_ms=0, rpcs={})
+        total['calls'] += 1
+        total['wall_ms'] += record['wall_ms']
+        for counter in COUNTERS:
+            total[counter] += record[counter]
+        for rpc, count in record['rpcs'].items():
+            total['rpcs'][rpc] = total['rpcs'].get(rpc, 0) + count
+
+
+def statsd_sink(address, prefix=STATSD_PREFIX):
+    """Return a sink that sends each record to the StatsD server at
+    address over UDP: a timer for the wall time and a counter for each
+    of the COUNTERS, scaled up by StatsD for the calls that weren't
+    sampled"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rate = '|@%s' % SAMPLE_RATE if SAMPLE_RATE < 1 else ''
+
+    def send(record):
+        name = '%s.%s' % (prefix, record['endpoint'])
+        lines = ['%s.wall_ms:%s|ms%s' % (name, record['wall_ms'], rate)]
+        lines.extend('%s.%s:%d|c%s' % (name, counter, record[counter], rate)
+                     for counter in COUNTERS)
+        sock.sendto('\n'.join(lines).encode('utf-8'), address)
+    return send
+
+
+# The sinks each record is passed to; a sink is any function that
+# takes a record
+SINKS = []
+if DEVELOPMENT:
+    SINKS.append(add_to_totals)
+if STATSD_ADDRESS:
+    SINKS.append(statsd_sink(STATSD_ADDRESS))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+
+"""
+The api_client.py file provides a small client for calling the
+Pelmanism API over HTTP (e.g. on a local dev_appserver), a helper
+that plays a game to the end and a helper that calls the admin-only
+handlers in main.py on a dev_appserver. It is used by the scripts in the tools
+directory and only needs the Python standard library.
+
+"""
+
+
+import hashlib
+import json
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import quote, urlencode
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib import quote, urlencode
+    from urllib2 import HTTPError, Request, urlopen
+
+
+DEFAULT_HOST = 'http://localhost:8080'
+API_ROOT = '/_ah/api/pelmanism/v1/'
+ADMIN_EMAIL = 'admin@example.com'
+
+
+class ApiError(Exception):
+    """Raised when an endpoint returns an error status"""
+
+    def __init__(self, name, status, body):
+        Exception.__init__(
+            self, '{} returned {}: {}'.format(name, status, body))
+        self.name = name
+        self.status = status
+        self.body = body
+
+
+class ApiClient(object):
+    """Calls the Pelmanism API endpoints; each method returns the
+    decoded JSON response"""
+
+    def __init__(self, host=DEFAULT_HOST):
+        self.host = host.rstrip('/')
+
+    def call(self, name, http_method, path, params=None, body=None):
+        """Call an endpoint and return the decoded JSON response
+
+        Args:
+                name: the endpoint name (used in error messages)
+                http_method: 'GET' or 'POST'
+                path: the endpoint path
+                params: a dict of query parameters
+                body: a dict sent as the JSON request body
+        Returns:
+                The decoded response (a dict)
+        Raises:
+                ApiError"""
+        url = self.host + API_ROOT + path
+        params = dict((k, v) for k, v in (params or {}).items()
+                      if v is not None)
+        if params:
+            url += '?' + urlencode(params)
+        body = dict((k, v) for k, v in (body or {}).items()
+                    if v is not None)
+        data = json.dumps(body).encode('utf-8') \
+            if http_method == 'POST' else None
+        request = Request(url, data=data,
+                          headers={'Content-Type': 'application/json'})
+        request.get_method = lambda: http_method
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            raise ApiError(name, e.code, e.read())
+        content = response.read()
+        return json.loads(content.decode('utf-8')) if content else {}
+
+    def create_user(self, user_name, email=None):
+        return self.call('create_user', 'POST', 'user',
+                         params={'user_name': user_name, 'email': email})
+
+    def new_game(self, user_name, attempts):
+        return self.call('new_game', 'POST', 'game',
+                         body={'user_name': user_name,
+                               'attempts': attempts})
+
+    def new_games(self, user_names, attempts, games_per_user=None):
+        return self.call('new_games', 'POST', 'games',
+                         body={'user_names': user_names,
+                               'attempts': attempts,
+                               'games_per_user': games_per_user})
+
+    def get_game(self, game_key):
+        return self.call('get_game', 'GET', 'game/' + quote(game_key))
+
+    def make_move(self, game_key, guess):
+        return self.call('make_move', 'POST', 'game/' + quote(game_key),
+                         body={'guess': guess})
+
+    def make_moves(self, game_key, guesses):
+        return self.call('make_moves', 'POST',
+                         'game/{}/moves'.format(quote(game_key)),
+                         body={'guesses': guesses})
+
+    def get_scores(self, cursor=None, page_size=None):
+        return self.call('get_scores', 'GET', 'scores',
+                         params={'cursor': cursor, 'page_size': page_size})
+
+    def get_user_scores(self, user_name, cursor=None, page_size=None):
+        return self.call('get_user_scores', 'GET',
+                         'scores/user/' + quote(user_name),
+                         params={'cursor': cursor, 'page_size': page_size})
+
+    def get_average_attempts_remaining(self):
+        return self.call('get_average_attempts_remaining', 'GET',
+                         'games/average_attempts')
+
+    def get_user_games(self, user_name, cursor=None, page_size=None):
+        return self.call('get_user_games', 'GET',
+                         'game/user/' + quote(user_name),
+                         params={'cursor': cursor, 'page_size': page_size})
+
+    def cancel_game(self, user_name, game_key):
+        return self.call('cancel_game', 'POST',
+                         'game/{}/user/{}'.format(quote(game_key),
+                                                  quote(user_name)))
+
+    def get_high_scores(self, number_of_results=None, cursor=None):
+        return self.call('get_high_scores', 'GET', 'high_scores',
+                         params={'number_of_results': number_of_results,
+                                 'cursor': cursor})
+
+    def get_user_rankings(self, cursor=None, page_size=None):
+        return self.call('get_user_rankings', 'GET', 'user_rankings',
+                         params={'cursor': cursor, 'page_size': page_size})
+
+    def get_game_history(self, game_key):
+        return self.call('get_game_history', 'GET', 'game_history',
+                         params={'urlsafe_game_key': game_key})
+
+    def replay_game(self, game_key, move=None):
+        return self.call('replay_game', 'GET', 'game_replay',
+                         params={'urlsafe_game_key': game_key,
+                                 'move': move})
+
+
+def admin_request(host, method, path):
+    """Make a request to an admin-only handler on the dev_appserver,
+    signed in as an admin; return the decoded JSON response (None if
+    there is none)
+
+    Raises:
+            ApiError"""
+    # The dev_appserver's login cookie is the email address, the admin
+    # flag and a user id made from the email address
+    user_id = str(int(hashlib.md5(ADMIN_EMAIL.encode('utf-8')).hexdigest(),
+                      16))[:20]
+    request = Request(
+        host.rstrip('/') + path,
+        data=b'' if method == 'POST' else None,
+        headers={'Cookie': 'dev_appserver_login="{}:True:{}"'.format(
+            ADMIN_EMAIL, user_id)})
+    request.get_method = lambda: method
+    try:
+        content = urlopen(request).read()
+    except HTTPError as e:
+        raise ApiError(path, e.code, e.read())
+    return json.loads(content.decode('utf-8')) if content else None
+
+
+def play_game(client, game):
+    """Play a game to the end, remembering every card that has been
+    turned over; return the final game form
+
+    Args:
+            client: an ApiClient
+            game: the game form returned by new_game
+    Returns:
+            The game form returned by the last make_move call"""
+    game_key = game['urlsafe_key']
+    size = len(game['disp_deck'])
+    seen = {}
+    matched = set()
+
+    def unknown(exclude=None):
+        for position in range(size):
+            if position not in seen and position != exclude:
+                return position
+
+    while not game.get('game_over'):
+        # Take a known pair if there is one; otherwise turn over a
+        # new card and look for its partner among the known cards
+        first = second = None
+        cards = {}
+        for position, card in sorted(seen.items()):
+            if position in matched:
+                continue
+            if card in cards:
+                first, second = cards[card], position
+                break
+            cards[card] = position
+        if first is None:
+            first = unknown()
+
+        game = client.make_move(game_key, first)
+        seen[first] = game['disp_deck'][first]
+        if second is None:
+            partners = [p for p, card in seen.items()
+                        if card == seen[first] and p != first and
+                        p not in matched]
+            second = partners[0] if partners else unknown(exclude=first)
+
+        game = client.make_move(game_key, second)
+        seen[second] = game['disp_deck'][second]
+        if seen[first] == seen[second]:
+            matched.update((first, second))
+    return game
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+
+"""
+The bench_engine.py script times the functions called on every move
+across deck sizes from 20 to 10,000 cards, to show how the rules of
+the game scale before bigger decks are offered:
+
+    python tools/bench_engine.py [--sizes 20 100 1000 10000]
+    python tools/bench_engine.py --sdk /path/to/google_appengine
+
+The functions timed are the ones in engine.py that do the work of
+game_logic.py: build_deck (deck_creation), check_flip (guess_error),
+display (which replaced reset_deck), apply_flip for the second card
+of a move and pack_move (won_or_lost) and points. With --sdk, the
+game_logic.py functions themselves are timed as well, with stub Game
+and User objects (game_logic.py needs the endpoints library from the
+App Engine SDK). engine.MAX_PAIRS is raised for the run so that decks
+bigger than the API allows can be timed.
+
+The script exits with a non-zero status if the time of any function
+grows faster than --max-exponent (1.3 by default) times the growth of
+the deck: e.g. a function that is linear in the number of cards has
+an exponent of about 1 and a quadratic one about 2. This check doesn't
+depend on the speed of the machine. The times can also be saved as a
+baseline with --save-baseline (by default to
+tools/baselines/bench_engine.json) and later runs are then checked
+against it as well, with --tolerance.
+
+"""
+
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine
+
+DEFAULT_SIZES = [20, 100, 1000, 10000]
+DEFAULT_BASELINE = os.path.join(ROOT, 'tools', 'baselines',
+                                'bench_engine.json')
+# The shortest time measured for each timing run, in seconds
+MIN_TIME = 0.05
+
+
+def sample_state(cards):
+    """Return a GameState for a deck of cards cards, with half of the
+    pairs matched and the first card of a move turned over"""
+    deck = engine.build_deck(cards // 2, rng=random.Random(0))
+    first = {}
+    matched = []
+    for position, card in enumerate(deck):
+        if card in first and len(matched) < cards // 2:
+            matched.extend((first.pop(card), position))
+        elif card not in first:
+            first[card] = position
+    pending = min(first.values())
+    return engine.GameState(
+        deck, cards * engine.MAX_ATTEMPTS_PER_PAIR,
+        matched=engine.bitmask(matched), pending=pending,
+        attempts_made=cards, matches_found=len(matched) // 2)
+
+
+def unmatched_pair(state):
+    """Return a position that doesn't match the pending card"""
+    for position, card in enumerate(state.deck):
+        if not state.matched >> position & 1 and \
+                position != state.pending and \
+                card != state.deck[state.pending]:
+            return position
+
+
+def engine_benchmarks(cards):
+    """Return the engine functions to time for a deck of cards cards,
+    by name, as functions with no arguments"""
+    state = sample_state(cards)
+    second = unmatched_pair(state)
+    revealed = [state.pending, second]
+    return {
+        'engine.build_deck': lambda: engine.build_deck(
+            cards // 2, rng=random.Random(1)),
+        'engine.check_flip': lambda: engine.check_flip(state, second),
+        'engine.display': lambda: engine.display(
+            state.deck, state.matched, revealed),
+        'engine.apply_flip': lambda: engine.apply_flip(state, second),
+        'engine.pack_move': lambda: engine.pack_move(
+            state.pending, second, False, 1451606400),
+        'engine.points': lambda: engine.points(
+            state.attempts_made, state.matches_found),
+    }
+
+
+class StubUser(object):
+    """Stands in for a User entity"""
+
+    def __init__(self):
+        self.name = 'benchmark'
+        self.games_played = 0
+        self.total_attempts = 100
+        self.total_points = 0
+        self.points_per_attempt = 0
+
+
+class StubGame(object):
+    """Stands in for a Game entity"""
+
+    def __init__(self, state):
+        self.deck = state.deck
+        self.matched = state.matched
+        self.match_list_int = []
+        self.pending_guess = state.pending
+        self.attempts_remaining = state.attempts_remaining
+        self.attempts_made = state.attempts_made
+        self.matches_found = state.matches_found
+        self.game_over = True
+        self.guess1_or_guess2 = 0
+        self.guess_history = []
+        self.moves = []
+
+    def get_matched(self):
+        return self.matched
+
+    def end_game(self, won=False):
+        self.game_over = True
+
+
+def game_logic_benchmarks(cards):
+    """Return the game_logic functions to time for a deck of cards
+    cards, by name, as functions with no arguments"""
+    import game_logic
+
+    state = sample_state(cards)
+    second = unmatched_pair(state)
+    game, user = StubGame(state), StubUser()
+    _, flip = engine.apply_flip(state, second)
+    # won_or_lost adds to the move log, so it is timed on a game whose
+    # log is emptied first
+    game_over_flip = flip._replace(game_over=True)
+
+    def won_or_lost():
+        game.moves = []
+        game_logic.won_or_lost(game, user, game_over_flip)
+
+    return {
+        'game_logic.deck_creation': lambda: game_logic.deck_creation(
+            cards // 2, 1),
+        'game_logic.guess_error': lambda: game_logic.guess_error(
+            state, second),
+        'game_logic.won_or_lost': won_or_lost,
+        'game_logic.points': lambda: game_logic.points(
+            game, state.attempts_made, state.matches_found, user),
+    }
+
+
+def time_call(func, repeat=3):
+    """Return the best time of a call to func, in seconds"""
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < MIN_TIME:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+
+def exponent(sizes, times):
+    """Return how fast a time grows with the deck size: the slope of
+    log(time) against log(size) between the smallest and largest
+    decks"""
+    return (math.log(times[-1] / times[0]) /
+            math.log(float(sizes[-1]) / sizes[0]))
+
+
+def setup(sdk):
+    """Put the App Engine SDK on the path"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the rules of the game across deck sizes')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='deck sizes (numbers of cards) to time')
+    parser.add_argument('--sdk', help='path to the App Engine SDK; '
+                        'also time the game_logic.py functions')
+    parser.add_argument('--max-exponent', type=float, default=1.3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed growth in time against the baseline')
+    args = parser.parse_args()
+    sizes = sorted(set(size - size % 2 for size in args.sizes))
+    if len(sizes) < 2 or sizes[0] < 2 * engine.MIN_PAIRS:
+        parser.error('at least two sizes of %d cards or more are needed'
+                     % (2 * engine.MIN_PAIRS))
+    engine.MAX_PAIRS = max(engine.MAX_PAIRS, sizes[-1] // 2)
+    suites = [engine_benchmarks]
+    if args.sdk:
+        setup(args.sdk)
+        suites.append(game_logic_benchmarks)
+
+    results = {}
+    for size in sizes:
+        for suite in suites:
+            for name, func in suite(size).items():
+                results.setdefault(name, {})[str(size)] = time_call(func)
+
+    row = '{:<26}' + ' {:>10}' * len(sizes) + ' {:>9}'
+    print(row.format('Function (microseconds)', *(sizes + ['Exponent'])))
+    failures = []
+    for name in sorted(results):
+        times = [results[name][str(size)] for size in sizes]
+        growth = exponent(sizes, times)
+        print(row.format(name, *(['%.2f' % (t * 1e6) for t in times] +
+                                 ['%.2f' % growth])))
+        if growth > args.max_exponent:
+            failures.append('{} grows with exponent {:.2f}'.format(
+                name, growth))
+
+    if args.save_baseline:
+        directory = os.path.dirname(args.baseline)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name in sorted(set(results) & set(baseline)):
+            for size, before in sorted(baseline[name].items()):
+                after = results[name].get(size)
+                if after is not None and after > before * (
+                        1 + args.tolerance):
+                    failures.append('{} ({} cards): {:.2f} -> {:.2f} '
+                                    'microseconds'.format(
+                                        name, size, before * 1e6,
+                                        after * 1e6))
+
+    if failures:
+        print('{} regression(s):'.format(len(failures)))
+        for failure in failures:
+            print('  ' + failure)
+        sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
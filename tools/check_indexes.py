@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+
+"""
+The check_indexes.py script calls every Pelmanism API endpoint, and
+the cron and task handlers in main.py that run queries, against a
+local dev_appserver that has been started in require-indexes mode:
+
+    dev_appserver.py --require_indexes=yes [DIRECTORY_NAME_OF_PROJECT]
+    python tools/check_indexes.py [--host http://localhost:8080]
+
+In this mode the dev_appserver fails any query that needs an index
+which isn't declared in index.yaml (rather than adding the index
+itself), so an endpoint or handler that returns an error points to a
+missing index. The script plays one game to the end, cancels another
+and leaves a third active so that every query returns results, then
+exits with a non-zero status if any call failed. The handlers are
+called signed in as an admin (see admin_request in api_client.py);
+the task handlers are called directly, rather than through the task
+queue, so that their errors are reported here.
+
+"""
+
+
+import argparse
+import sys
+import time
+
+from api_client import (DEFAULT_HOST, ApiClient, ApiError, admin_request,
+                        play_game)
+
+# The cron and task handlers that run queries, as (method, path)
+HANDLERS = [
+    ('GET', '/crons/send_reminder'),
+    ('POST', '/tasks/send_reminder_page'),
+    ('POST', '/tasks/send_reminder_batch'),
+    ('POST', '/tasks/verify_games'),
+    ('POST', '/tasks/rebuild_active_game_stats'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Call every endpoint on a dev_appserver that was '
+                    'started with --require_indexes=yes')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    args = parser.parse_args()
+
+    client = ApiClient(args.host)
+    user_name = 'index-check-{}'.format(int(time.time() * 1000))
+    failures = []
+
+    def check(name, func, *func_args, **func_kwargs):
+        try:
+            result = func(*func_args, **func_kwargs)
+        except ApiError as e:
+            failures.append(name)
+            print('FAIL {}: {}'.format(name, e))
+            return None
+        print('ok   {}'.format(name))
+        return result
+
+    check('create_user', client.create_user, user_name,
+          '{}@example.com'.format(user_name))
+    won_game = check('new_game', client.new_game, user_name, 60)
+    cancelled_game = check('new_game', client.new_game, user_name, 60)
+    check('new_games', client.new_games, [user_name], 60, 2)
+    active_game = check('new_game', client.new_game, user_name, 60)
+
+    if won_game:
+        check('get_game', client.get_game, won_game['urlsafe_key'])
+        check('make_move', play_game, client, won_game)
+        check('get_game_history', client.get_game_history,
+              won_game['urlsafe_key'])
+        check('replay_game', client.replay_game, won_game['urlsafe_key'],
+              1)
+    if cancelled_game:
+        check('cancel_game', client.cancel_game, user_name,
+              cancelled_game['urlsafe_key'])
+    if active_game:
+        check('make_moves', client.make_moves, active_game['urlsafe_key'],
+              [0, 1, 2])
+
+    check('get_scores', client.get_scores)
+    check('get_user_scores', client.get_user_scores, user_name)
+    check('get_average_attempts_remaining',
+          client.get_average_attempts_remaining)
+    check('get_user_games', client.get_user_games, user_name)
+    check('get_high_scores', client.get_high_scores)
+    check('get_user_rankings', client.get_user_rankings)
+
+    for method, path in HANDLERS:
+        check(path, admin_request, args.host, method, path)
+
+    if failures:
+        print('{} endpoint(s) failed: {}'.format(
+            len(failures), ', '.join(failures)))
+        sys.exit(1)
+    print('All endpoints and handlers ran without missing indexes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+
+"""
+The load_test.py script drives realistic traffic against a local
+dev_appserver and reports, for each endpoint, the latency seen by the
+client along with the datastore and memcache RPCs made and the bytes
+of entities written by the server (see rpc_stats.py):
+
+    dev_appserver.py [DIRECTORY_NAME_OF_PROJECT]
+    python tools/load_test.py [--host http://localhost:8080]
+
+Each simulated user is created and plays --games games to the end
+with make_move (so most calls are make_move); the scores, high scores
+and rankings are read after each round of games, and each user's
+games and scores at the end.
+
+The results can be saved as a baseline with --save-baseline (by
+default to tools/baselines/load_test.json); later runs are compared
+with the baseline and the script exits with a non-zero status if any
+endpoint's RPCs or bytes written per call grew by more than
+--tolerance, or its 90th percentile latency by more than
+--latency-tolerance. Latency depends on the machine, so a baseline
+should be saved on the machine that runs the comparison.
+
+"""
+
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+from api_client import DEFAULT_HOST, ApiClient, admin_request, play_game
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baselines', 'load_test.json')
+RPC_STATS_PATH = '/tasks/rpc_stats'
+
+
+class TimedClient(ApiClient):
+    """An ApiClient that records the latency (in milliseconds) of
+    every call by endpoint"""
+
+    def __init__(self, host=DEFAULT_HOST):
+        ApiClient.__init__(self, host)
+        self.latencies = {}
+
+    def call(self, name, *args, **kwargs):
+        start = time.time()
+        try:
+            return ApiClient.call(self, name, *args, **kwargs)
+        finally:
+            self.latencies.setdefault(name, []).append(
+                (time.time() - start) * 1000)
+
+
+def percentile(values, p):
+    """Return the pth percentile of values (nearest rank)"""
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def run(client, users, games, attempts):
+    """Create users and play their games"""
+    prefix = 'load-test-{}'.format(int(time.time() * 1000))
+    names = ['{}-{}'.format(prefix, i) for i in range(users)]
+    for name in names:
+        client.create_user(name, '{}@example.com'.format(name))
+    for _ in range(games):
+        for name in names:
+            game = client.new_game(name, attempts)
+            client.get_game(game['urlsafe_key'])
+            play_game(client, game)
+        client.get_scores()
+        client.get_high_scores()
+        client.get_user_rankings()
+    for name in names:
+        client.get_user_games(name)
+        client.get_user_scores(name)
+
+
+def results(latencies, totals):
+    """Combine the client's latencies and the server's RPC totals into
+    one set of results per endpoint"""
+    combined = {}
+    for name, values in latencies.items():
+        total = totals.get(name, {})
+        calls = total.get('calls') or len(values)
+        combined[name] = {
+            'calls': len(values),
+            'p50_ms': round(percentile(values, 50), 1),
+            'p90_ms': round(percentile(values, 90), 1),
+            'p99_ms': round(percentile(values, 99), 1),
+            'rpcs_per_call': round(
+                sum(total.get('rpcs', {}).values()) / float(calls), 2),
+            'write_bytes_per_call': round(
+                total.get('write_bytes', 0) / float(calls), 1),
+        }
+    return combined
+
+
+def report(combined):
+    """Print a table of the results for each endpoint"""
+    row = '{:<32} {:>6} {:>9} {:>9} {:>9} {:>10} {:>12}'
+    print(row.format('Endpoint', 'Calls', 'p50 ms', 'p90 ms', 'p99 ms',
+                     'RPCs/call', 'Bytes/call'))
+    for name in sorted(combined):
+        r = combined[name]
+        print(row.format(name, r['calls'], r['p50_ms'], r['p90_ms'],
+                         r['p99_ms'], r['rpcs_per_call'],
+                         r['write_bytes_per_call']))
+
+
+def regressions(combined, baseline, tolerance, latency_tolerance):
+    """Return a description of each result that is worse than the
+    baseline by more than the tolerance allowed"""
+    found = []
+    checks = (('rpcs_per_call', tolerance),
+              ('write_bytes_per_call', tolerance),
+              ('p90_ms', latency_tolerance))
+    for name in sorted(set(combined) & set(baseline)):
+        for key, allowed in checks:
+            before, after = baseline[name][key], combined[name][key]
+            if after > before * (1 + allowed) and after - before > 0.5:
+                found.append('{} {}: {} -> {}'.format(
+                    name, key, before, after))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a load test against a dev_appserver')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--games', type=int, default=2,
+                        help='games played by each user')
+    parser.add_argument('--attempts', type=int, default=60)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed growth in RPCs and bytes per call')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                        help='allowed growth in p90 latency')
+    args = parser.parse_args()
+
+    client = TimedClient(args.host)
+    admin_request(args.host, 'DELETE', RPC_STATS_PATH)
+    run(client, args.users, args.games, args.attempts)
+    combined = results(client.latencies,
+                       admin_request(args.host, 'GET', RPC_STATS_PATH))
+    report(combined)
+
+    if args.save_baseline:
+        directory = os.path.dirname(args.baseline)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.baseline, 'w') as f:
+            json.dump(combined, f, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(args.baseline))
+        return
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare with; save one with '
+              '--save-baseline')
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(combined, baseline, args.tolerance,
+                        args.latency_tolerance)
+    if found:
+        print('{} regression(s) against the baseline:'.format(len(found)))
+        for regression in found:
+            print('  ' + regression)
+        sys.exit(1)
+    print('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+
+"""
+The write_cost.py script counts the index rows written for the
+entities saved by one make_move call (the Game and the User, plus the
+Score when the game ends), with every property indexed (the ndb
+default, used before the properties that are never queried were
+marked indexed=False) and with the indexes the models declare now:
+
+    python tools/write_cost.py --sdk /path/to/google_appengine
+
+Each indexed property value is written to two built-in indexes
+(ascending and descending), and each composite index in index.yaml
+adds one row per entity of its kind. The counts are for a game in
+progress on the default deck of 20 cards; --pairs changes the size
+of the deck.
+
+"""
+
+
+import argparse
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(sdk):
+    """Put the App Engine SDK and the app on the path"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('APPLICATION_ID', 'dev~pelmanism')
+
+
+def composite_indexes():
+    """Return the number of composite indexes in index.yaml for each
+    kind"""
+    counts = {}
+    with open(os.path.join(ROOT, 'index.yaml')) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('- kind:'):
+                kind = line.split(':', 1)[1].strip()
+                counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def index_rows(entity, all_indexed):
+    """Return the number of index rows written when the entity is
+    saved; if all_indexed is True, count every property that can be
+    indexed as if it were"""
+    from google.appengine.ext import ndb
+
+    rows = 0
+    for prop in entity._properties.values():
+        indexed = prop._indexed
+        if all_indexed and not isinstance(
+                prop, (ndb.BlobProperty, ndb.LocalStructuredProperty)):
+            indexed = True
+        if not indexed:
+            continue
+        value = prop._get_value(entity)
+        # ndb also stores (and indexes) None for unset properties
+        rows += 2 * (len(value) if prop._repeated else 1)
+    return rows + composite_indexes().get(entity._get_kind(), 0)
+
+
+def sample_entities(pairs):
+    """Return a Game, User and Score as saved by the second guess of
+    the last move of a game"""
+    from google.appengine.ext import ndb
+
+    import engine
+    from models.game import Game
+    from models.user import User
+
+    user = User(key=ndb.Key(User, 1), name='benchmark',
+                email='benchmark@example.com', games_played=3,
+                total_attempts=90, total_points=900, points_per_attempt=10)
+    deck = engine.build_deck(pairs, rng=random.Random(0))
+    matched = engine.bitmask(
+        i for i, card in enumerate(deck) if card < deck[0])
+    attempts_made = pairs * 2
+    game = Game(key=ndb.Key(Game, 1), user=user.key, user_name=user.name,
+                deck=deck, seed=0, attempts_allowed=pairs * 6,
+                attempts_remaining=pairs * 6 - attempts_made,
+                attempts_made=attempts_made, matched=matched,
+                matches_found=len(engine.positions(matched)) // 2,
+                guess1_or_guess2=attempts_made * 2,
+                moves=[engine.pack_move(0, 1, False, 1451606400)] *
+                attempts_made,
+                time_created='2016-01-01 00:00:00.000000')
+    score = game.end_game(True)
+    score.key = ndb.Key('Score', 1)
+    return game, user, score
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Count the index rows written by make_move')
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine SDK')
+    parser.add_argument('--pairs', type=int, default=10)
+    args = parser.parse_args()
+    setup(args.sdk)
+
+    entities = sample_entities(args.pairs)
+    print('{:<8} {:>12} {:>12}'.format('Kind', 'All indexed', 'Now'))
+    totals = [0, 0]
+    for entity in entities:
+        before = index_rows(entity, True)
+        after = index_rows(entity, False)
+        totals[0] += before
+        totals[1] += after
+        print('{:<8} {:>12} {:>12}'.format(
+            entity._get_kind(), before, after))
+    print('{:<8} {:>12} {:>12}'.format('Total', totals[0], totals[1]))
+    print('(a move that doesn\'t end the game writes only the Game and '
+          'the User)')
+
+
+if __name__ == '__main__':
+    main()
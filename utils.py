@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 
 """
-The utils.py file provides a function which is used in pelmanism_api.py
-to retrieve game information.
+The utils.py file provides helper functions which are used in
+pelmanism_api.py to retrieve game information, to fetch pages of
+query results and to fill in the user names shown in game and
+score forms.
 
 """
 
 
 import logging
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns the ndb.model entity that is connected to the urlsafe key;
     checks to ensure that the type of entity returned is of the correct
@@ -42,3 +49,81 @@ def get_by_urlsafe(urlsafe, model):
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def fetch_page(query, urlsafe_cursor=None, page_size=None):
+    """Returns one page of results for an ndb query; the page size
+    defaults to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+
+    Args:
+            query: an ndb query
+            urlsafe_cursor: a urlsafe cursor string returned with the
+                previous page (None for the first page)
+            page_size: the number of results to return
+    Returns:
+            A list of entities and the urlsafe cursor string for the
+            next page (None if there are no more results)
+    Raises:
+            endpoints.BadRequestException"""
+    if not page_size or page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+    entities, next_cursor, more = query.fetch_page(
+        page_size, start_cursor=cursor)
+    if more and next_cursor:
+        return entities, next_cursor.urlsafe()
+    return entities, None
+
+
+def page_list(items, cursor=None, page_size=None):
+    """Returns one page of an already computed list, with the same
+    page size rules and cursor handling as fetch_page
+
+    Args:
+            items: a list
+            cursor: the cursor string returned with the previous page
+                (None for the first page)
+            page_size: the number of items to return
+    Returns:
+            A list of items and the cursor string for the next page
+            (None if there are no more items)
+    Raises:
+            endpoints.BadRequestException"""
+    if not page_size or page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    try:
+        start = int(cursor) if cursor else 0
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+    if start < 0:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+    end = start + page_size
+    if end < len(items):
+        return items[start:end], str(end)
+    return items[start:end], None
+
+
+def fill_user_names(entities):
+    """Fills in the user_name of each Game or Score entity that doesn't
+    have one yet; the missing users are looked up with a single batch
+    get rather than one get per entity
+
+    Args:
+            entities: a list of Game and/or Score entities
+    Returns:
+            The same list of entities"""
+    keys = list(set(e.user for e in entities if e.user_name is None))
+    if keys:
+        names = dict((user.key, user.name)
+                     for user in ndb.get_multi(keys) if user)
+        for e in entities:
+            if e.user_name is None:
+                e.user_name = names.get(e.user)
+    return entities